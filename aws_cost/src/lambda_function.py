@@ -1,9 +1,14 @@
 import os
 import time
 import json
+import calendar
+import urllib.parse
 import urllib.request
 import pandas as pd
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from functools import wraps
 from datetime import datetime, timedelta
+import boto3
 from pandas.io.json import json_normalize
 from selenium import webdriver
 from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
@@ -15,6 +20,109 @@ SLACK_CHANNEL = os.environ['SLACK_CHANNEL']
 # alphaus.cloudのユーザ名とパスワードを環境変数から読み込む
 USER_ID = os.environ['USER_ID']
 USER_PS = os.environ['USER_PS']
+# レポートの集計軸（by）とベンダーを環境変数から読み込む（カンマ区切り）
+# 例）REPORT_DIMENSIONS=service,account,region
+REPORT_DIMENSIONS = [i.strip() for i in os.environ.get('REPORT_DIMENSIONS', 'service').split(',') if i.strip()] or ['service']
+REPORT_VENDORS = [i.strip() for i in os.environ.get('REPORT_VENDORS', 'aws').split(',') if i.strip()] or ['aws']
+# 月末の予測コストがこの金額（$）を超えるサービスを警告する（未設定なら警告しない）
+PROJECTION_THRESHOLD = float(os.environ['PROJECTION_THRESHOLD']) if os.environ.get('PROJECTION_THRESHOLD') else None
+# 直近何日分の日次コストの平均を、1日あたりのコストとするか
+BURN_RATE_DAYS = int(os.environ.get('BURN_RATE_DAYS', 7))
+# 日次コストのキャッシュの保存先（/tmpには常に保存し、COST_CACHE_BUCKETが設定されていればS3にも保存）
+COST_CACHE_BUCKET = os.environ.get('COST_CACHE_BUCKET')
+COST_CACHE_PATH = '/tmp/daily_costs_{}.json'
+# 直近のコストは後から更新されるので、キャッシュがあっても直近この日数分は取り直す
+COST_REFETCH_DAYS = 2
+# trueならlambda_handlerをcProfileとtracemallocで計測する
+PROFILE = os.environ.get('PROFILE', 'false').lower() == 'true'
+PROFILE_TOP_N = int(os.environ.get('PROFILE_TOP_N', 20))
+# profile_handlerで計測中かどうか
+_profiling = False
+
+
+class _InlineExecutor(Executor):
+    """
+    計測中に使うexecutor。スレッドを使わずに、呼び出したスレッドで順番に実行する
+    """
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+
+def get_executor(max_workers):
+    """
+    並列実行に使うexecutorを取得する
+    cProfileは呼び出したスレッドしか計測できないので、profile_handlerで計測中は
+    ワーカースレッドを使わずに、計測しているスレッドで順番に実行するexecutorを返す
+
+    Parameters
+    ----------
+    max_workers : int
+        並列実行数
+
+    returns
+    -------
+    executor : concurrent.futures.Executor
+        ThreadPoolExecutor（計測中は_InlineExecutor）
+    """
+    if _profiling:
+        return _InlineExecutor()
+    return ThreadPoolExecutor(max_workers=max_workers)
+
+
+def profile_handler(handler):
+    """
+    PROFILEがtrue、またはeventに{"profile": true}が指定されたときだけ、
+    handlerをcProfileとtracemallocで計測して上位PROFILE_TOP_N件を表示する
+    （計測中はget_executor()がスレッドを使わずに順番に実行するので、並列処理の中身も計測できる。
+    　そのかわり処理時間は並列実行時より長くなる）
+
+    Parameters
+    ----------
+    handler : function
+        lambda_handler(event, context)
+
+    returns
+    -------
+    wrapper : function
+        計測付きのhandler
+    """
+    @wraps(handler)
+    def wrapper(event, context):
+        if not (PROFILE or (isinstance(event, dict) and event.get('profile'))):
+            return handler(event, context)
+
+        # 計測しないときのコストを無くすため、ここでimportする
+        import cProfile
+        import pstats
+        import tracemalloc
+
+        global _profiling
+        tracemalloc.start()
+        profiler = cProfile.Profile()
+        _profiling = True
+        try:
+            return profiler.runcall(handler, event, context)
+        finally:
+            _profiling = False
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+
+            # 累積時間の上位の関数
+            stats = pstats.Stats(profiler).stats
+            print('profile: top {} functions by cumulative time'.format(PROFILE_TOP_N))
+            for (filename, lineno, funcname), (cc, nc, tt, ct, callers) in sorted(stats.items(), key=lambda i: i[1][3], reverse=True)[:PROFILE_TOP_N]:
+                print('  {:8.3f}s {:8.3f}s {:>7} {}:{}({})'.format(ct, tt, nc, os.path.basename(filename), lineno, funcname))
+            # メモリ確保量の上位の箇所
+            print('profile: top {} allocation sites'.format(PROFILE_TOP_N))
+            for stat in snapshot.statistics('lineno')[:PROFILE_TOP_N]:
+                frame = stat.traceback[0]
+                print('  {:10.1f}KiB {:>7} {}:{}'.format(stat.size / 1024, stat.count, os.path.basename(frame.filename), frame.lineno))
+    return wrapper
 
 
 def getAuthId(user_id, user_ps):
@@ -85,7 +193,27 @@ def getAuthId(user_id, user_ps):
     return 'Bearer ' + auth_id
 
 
-def getCost(auth_id):
+def buildOpener(auth_id):
+    """
+    Authorizationを設定したHTTPクライアントを作成
+    （複数のAPI呼び出しで共有する）
+
+    Parameters
+    ----------
+    auth_id : string
+        APIにアクセスするためのAuthorization
+
+    returns
+    -------
+    opener : urllib.request.OpenerDirector
+        Authorizationを設定したHTTPクライアント
+    """
+    opener = urllib.request.build_opener()
+    opener.addheaders = [('Authorization', auth_id)]
+    return opener
+
+
+def getCost(auth_id, by='service', vendor='aws', opener=None):
     """
     alphaus.cloudにAPI接続して今月の費用を取得
     
@@ -93,6 +221,12 @@ def getCost(auth_id):
     ----------
     auth_id : string
         APIにアクセスするためのAuthorization
+    by : string
+        集計軸（service, account, regionなど）
+    vendor : string
+        ベンダー（aws, gcpなど）
+    opener : urllib.request.OpenerDirector
+        buildOpener()で作成したHTTPクライアント（Noneなら新しく作成）
 
     returns
     -------
@@ -101,30 +235,234 @@ def getCost(auth_id):
      : [string]
         コスト内訳
     """
+    if opener is None:
+        opener = buildOpener(auth_id)
     pd.options.display.float_format = '{:.1f}'.format
-    # 費用取得期間
+    # 費用取得期間（今月分だけ取得する）
     today = datetime.today()
-    lastyear = today - timedelta(days=365)
     
     # API費用を取得
-    req = urllib.request.Request('https://api.alphaus.cloud/m/wave/reports/company/monthly?from=' + lastyear.strftime('%Y-%m-01') + '&to=' + today.strftime('%Y-%m-01') + '&by=service&vendor=aws')
-    req.add_header('Authorization', auth_id)
-    with urllib.request.urlopen(req) as res:
+    url = 'https://api.alphaus.cloud/m/wave/reports/company/monthly?' + urllib.parse.urlencode({
+        'from': today.strftime('%Y-%m-01'),
+        'to': today.strftime('%Y-%m-01'),
+        'by': by,
+        'vendor': vendor,
+    })
+    with opener.open(url) as res:
         json_data = json.loads(res.read().decode('utf-8'))
     
     # 取得した情報をから今月分を取得
     cols = ['id', 'date', 'unblended_cost', 'true_unblended_cost', 'blended_cost', 'timestamp']
     df_items = pd.DataFrame(columns=cols)
     
-    for entry_json in json_data['aws']:
-        df_items = df_items.append(json_normalize(entry_json, 'date', 'id'), ignore_index=True )
+    if json_data.get(vendor):
+        df_items = json_normalize(json_data[vendor], 'date', 'id')
     
     df = df_items[df_items['date'] == today.strftime('%Y-%m')].loc[:,['id', 'true_unblended_cost']]
-    df_new = df.rename(columns={'id': 'Service', 'true_unblended_cost': 'Cost'})
+    df_new = df.rename(columns={'id': by.capitalize(), 'true_unblended_cost': 'Cost'})
 
     return df_new['Cost'].sum(), df_new.sort_values('Cost', ascending=False).to_string(index=False)
+
+
+def getCosts(auth_id, dimensions, vendors, opener=None):
+    """
+    集計軸×ベンダーの今月の費用を、1つのHTTPクライアントを共有して並列に取得
+    
+    Parameters
+    ----------
+    auth_id : string
+        APIにアクセスするためのAuthorization
+    dimensions : [string]
+        集計軸のリスト
+    vendors : [string]
+        ベンダーのリスト
+    opener : urllib.request.OpenerDirector
+        buildOpener()で作成したHTTPクライアント（Noneなら新しく作成）
+
+    returns
+    -------
+    costs : [((string, string), (int, string))]
+        ((集計軸, ベンダー), (今月の総コスト, コスト内訳))のリスト
+    """
+    if opener is None:
+        opener = buildOpener(auth_id)
+    targets = [(by, vendor) for vendor in vendors for by in dimensions]
+    with get_executor(len(targets)) as executor:
+        results = list(executor.map(lambda t: getCost(auth_id, t[0], t[1], opener), targets))
+
+    return list(zip(targets, results))
   
 
+def loadDailyCostCache(vendor, month):
+    """
+    日次コストのキャッシュを読み込む
+    COST_CACHE_BUCKETが設定されていればS3から、なければ/tmpから読み込む
+
+    Parameters
+    ----------
+    vendor : string
+        ベンダー
+    month : string
+        対象月（YYYY-MM）
+
+    returns
+    -------
+    cache : dict()
+        {日付（YYYY-MM-DD）: {サービス: コスト}}（対象月の分だけ）
+    """
+    path = COST_CACHE_PATH.format(vendor)
+    try:
+        if COST_CACHE_BUCKET:
+            body = boto3.client('s3').get_object(Bucket=COST_CACHE_BUCKET, Key=os.path.basename(path))['Body'].read()
+        else:
+            with open(path, 'rb') as f:
+                body = f.read()
+        cache = json.loads(body.decode('utf-8'))
+    except Exception as e:
+        # キャッシュが無ければ今月分を全て取得する
+        return dict()
+    return {k: v for k, v in cache.items() if k.startswith(month)}
+
+
+def saveDailyCostCache(vendor, cache):
+    """
+    日次コストのキャッシュを保存する
+    /tmpには常に保存し、COST_CACHE_BUCKETが設定されていればS3にも保存する
+
+    Parameters
+    ----------
+    vendor : string
+        ベンダー
+    cache : dict()
+        {日付（YYYY-MM-DD）: {サービス: コスト}}
+    """
+    path = COST_CACHE_PATH.format(vendor)
+    body = json.dumps(cache).encode('utf-8')
+    with open(path, 'wb') as f:
+        f.write(body)
+    if COST_CACHE_BUCKET:
+        boto3.client('s3').put_object(Bucket=COST_CACHE_BUCKET, Key=os.path.basename(path), Body=body)
+
+
+def getDailyCost(auth_id, vendor='aws', opener=None):
+    """
+    alphaus.cloudにAPI接続して今月のサービスごとの日次コストを取得
+    キャッシュにある日付は取得せず、直近COST_REFETCH_DAYS日分とそれ以降だけ取得する
+    （今日の分は途中までしか集計されていないので、昨日までの確定した分だけ取得する）
+
+    Parameters
+    ----------
+    auth_id : string
+        APIにアクセスするためのAuthorization
+    vendor : string
+        ベンダー（aws, gcpなど）
+    opener : urllib.request.OpenerDirector
+        buildOpener()で作成したHTTPクライアント（Noneなら新しく作成）
+
+    returns
+    -------
+    df : pandas.DataFrame
+        サービス×日付の日次コスト
+    """
+    if opener is None:
+        opener = buildOpener(auth_id)
+    today = datetime.today()
+    yesterday = today - timedelta(days=1)
+    # 以前のキャッシュに今日の途中までの分が残っていても使わない
+    cache = {k: v for k, v in loadDailyCostCache(vendor, today.strftime('%Y-%m')).items() if k < today.strftime('%Y-%m-%d')}
+
+    # 取得開始日（キャッシュの最終日からCOST_REFETCH_DAYS日前、ただし今月1日より前にはしない）
+    start = today.replace(day=1)
+    if cache:
+        start = max(start, datetime.strptime(max(cache), '%Y-%m-%d') - timedelta(days=COST_REFETCH_DAYS))
+
+    # 月初（昨日が先月）は今月の確定分がないので取得しない
+    json_data = dict()
+    if start.date() <= yesterday.date():
+        url = 'https://api.alphaus.cloud/m/wave/reports/company/daily?' + urllib.parse.urlencode({
+            'from': start.strftime('%Y-%m-%d'),
+            'to': yesterday.strftime('%Y-%m-%d'),
+            'by': 'service',
+            'vendor': vendor,
+        })
+        with opener.open(url) as res:
+            json_data = json.loads(res.read().decode('utf-8'))
+
+    if json_data.get(vendor):
+        df_items = json_normalize(json_data[vendor], 'date', 'id')
+        # 取り直した日付はキャッシュを上書きする
+        for date in df_items['date'].unique():
+            cache[date] = dict()
+        for entry in df_items.loc[:, ['id', 'date', 'true_unblended_cost']].itertuples(index=False):
+            cache[entry.date][entry.id] = entry.true_unblended_cost
+        saveDailyCostCache(vendor, cache)
+
+    return pd.DataFrame(cache).fillna(0).sort_index(axis=1)
+
+
+def projectCost(df_daily, today=None):
+    """
+    日次コストからサービスごとの1日あたりのコストと月末の予測コストを計算
+    （全サービス分をまとめて計算する）
+
+    Parameters
+    ----------
+    df_daily : pandas.DataFrame
+        getDailyCost()で取得したサービス×日付の日次コスト
+    today : datetime
+        基準日（Noneなら今日）
+
+    returns
+    -------
+    df : pandas.DataFrame
+        サービスごとの'MTD'（今月の累計）, 'BurnRate'（直近BURN_RATE_DAYS日の平均）, 'Projection'（月末の予測）
+    """
+    if today is None:
+        today = datetime.today()
+    days_in_month = calendar.monthrange(today.year, today.month)[1]
+    if df_daily.empty:
+        return pd.DataFrame(columns=['MTD', 'BurnRate', 'Projection'])
+
+    # 最後にコストが確定している日の翌日（通常は今日）から月末までの日数
+    remaining_days = days_in_month - int(df_daily.columns[-1][-2:])
+    mtd = df_daily.sum(axis=1)
+    burn_rate = df_daily.iloc[:, -BURN_RATE_DAYS:].mean(axis=1)
+    df = pd.DataFrame({
+        'MTD': mtd,
+        'BurnRate': burn_rate,
+        'Projection': mtd + burn_rate * remaining_days,
+    })
+    df.index.name = 'Service'
+
+    return df.sort_values('Projection', ascending=False)
+
+
+def getProjections(auth_id, vendors, opener=None):
+    """
+    ベンダーごとの月末の予測コストを並列に取得
+
+    Parameters
+    ----------
+    auth_id : string
+        APIにアクセスするためのAuthorization
+    vendors : [string]
+        ベンダーのリスト
+    opener : urllib.request.OpenerDirector
+        buildOpener()で作成したHTTPクライアント（Noneなら新しく作成）
+
+    returns
+    -------
+    projections : [(string, pandas.DataFrame)]
+        (ベンダー, projectCost()の結果)のリスト
+    """
+    if opener is None:
+        opener = buildOpener(auth_id)
+    with get_executor(len(vendors)) as executor:
+        results = list(executor.map(lambda vendor: projectCost(getDailyCost(auth_id, vendor, opener)), vendors))
+
+    return list(zip(vendors, results))
+
+
 def send_slack_message(text, username, channel, slack_endpoint_url):
     """
     Slackにメッセージを送信
@@ -159,12 +497,26 @@ def send_slack_message(text, username, channel, slack_endpoint_url):
     return body
     
     
+@profile_handler
 def lambda_handler(event, context):
     auth_id = getAuthId(USER_ID, USER_PS)
 
     if auth_id != '':
-        costall, msg = getCost(auth_id)
-        msg = 'this month costs: $ ' + str("{:.1f}".format(costall)) + '\n\n```' + msg + '```'
+        opener = buildOpener(auth_id)
+        costs = getCosts(auth_id, REPORT_DIMENSIONS, REPORT_VENDORS, opener)
+        # 総コストは1つ目の集計軸の合計（集計軸が違っても総額は同じ）
+        costall = sum(cost for (by, vendor), (cost, _) in costs if by == REPORT_DIMENSIONS[0])
+        msg = 'this month costs: $ ' + str("{:.1f}".format(costall))
+        for (by, vendor), (cost, detail) in costs:
+            msg += '\n\n' + vendor + ' by ' + by + ': $ ' + str("{:.1f}".format(cost)) + '\n```' + detail + '```'
+
+        # 月末の予測コスト
+        for vendor, df_projection in getProjections(auth_id, REPORT_VENDORS, opener):
+            msg += '\n\n' + vendor + ' month-end projection: $ ' + str("{:.1f}".format(df_projection['Projection'].sum())) + '\n```' + df_projection.to_string() + '```'
+            if PROJECTION_THRESHOLD is not None:
+                over = df_projection[df_projection['Projection'] > PROJECTION_THRESHOLD].index
+                if len(over) > 0:
+                    msg += '\n:warning: projected over $ ' + str("{:.1f}".format(PROJECTION_THRESHOLD)) + ': ' + ', '.join(over)
     else:
         msg = 'Not a valid account name or password.'
     print(msg)
@@ -8,13 +8,16 @@ AWS lambdaで必要なタイミングで実行することで、
 ・タイムアウト時間の延長（10分あれば十分？）
 
 ■更新時設定（初期にも必要）
-・AWS lambdaのコード更新
+・AWS lambdaのコード更新（service_registry.pyも同じ階層に配置する）
 ・role権限の更新
 
 ＜確認対象サービス＞
-・SageMakerStudio（JupyterServer, KernelGateway）
+service_registry.pyのSERVICESに登録されたサービス（EC2以外）
+・SageMakerStudio（JupyterServer, KernelGateway, JupyterLab, CodeEditor）
 ・SageMakerEndpoint
+・SageMakerNotebookInstance
 ・RedshiftCluster
+・RedshiftServerless（Workgroup）
 ・ComprehendEndpoint
 
 ＜roleに設定すべきポリシー＞
@@ -22,162 +25,98 @@ AWS lambdaで必要なタイミングで実行することで、
 ・AmazonSageMakerFullAccess
 ・AmazonRedshiftFullAccess
 ・ComprehendFullAccess
+・（ACCOUNT_ROLE_ARNSを使う場合）該当roleへのsts:AssumeRole
+　（AssumeRole先のroleにも上記のポリシーと、このlambdaのroleを信頼するポリシーを設定する）
+
+＜環境変数（任意）＞
+・AWS_MAX_ATTEMPTS : API呼び出しの最大試行回数（デフォルト10）
+・MAX_WORKERS : アカウント×リージョンの並列実行数（デフォルト16）
+・ACCOUNT_ROLE_ARNS : 他アカウントもチェックする場合、AssumeRoleするrole ARN（カンマ区切り）
+・INCLUDE_SELF_ACCOUNT : lambda自身のアカウントもチェックするか（デフォルトtrue）
+・PROFILE : trueならlambda_handlerの処理時間とメモリ確保量を計測して表示する
+　（eventに{"profile": true}を指定しても同じ）
+・PROFILE_TOP_N : 計測結果を表示する件数（デフォルト20）
 
 """
 
+import os
 import json
-import boto3
+from collections import Counter
 import botocore
+from service_registry import (
+    SERVICES, list_resources,
+    get_accounts, account_id, get_session, get_client, print_throttle_counts, profile_handler, get_executor,
+)
 
-def check_sagemaker_studios(region):
-    """
-    sagemaker studioの['KernelGateway', 'JupyterServer']が
-    InServiceならその数を表示する
+# アカウント×リージョンを並列に確認するときのスレッド数
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', 16))
 
-    Parameters
-    ----------
-    region : string
-        AWSのリージョン情報
-
-    returns
-    -------
-    res : [string]
-        表示文章（サービスごとの稼働数のカウント結果）
-    """
-    client = boto3.Session().client(service_name="sagemaker", region_name=region)
-    cnt = {'KernelGateway':0, 'JupyterServer':0}
-    res = []
-    try:
-        for app in client.list_apps()['Apps']:
-            if app['Status']=='InService' and app['AppType'] in ['KernelGateway', 'JupyterServer']:
-                cnt[ app['AppType'] ] += 1
-        for k,v in cnt.items():
-            res.append('InService sagemaker {} : {}'.format(k,v))
-    except botocore.exceptions.ClientError as e:
-        res.append('region-error in {} about {}'.format(region, 'sagemaker studio'))
-        # print(e)
-    return res
-    
-
-def check_sagemaker_endpoints(region):
-    """
-    sagemaker studioのendpointが
-    InServiceならその数を表示する
-
-    Parameters
-    ----------
-    region : string
-        AWSのリージョン情報
-
-    returns
-    -------
-    res : [string]
-        表示文章（サービスごとの稼働数のカウント結果）
-    """
-    client = boto3.Session().client(service_name="sagemaker", region_name=region)
-    res = []
-    try:
-        ep_list = client.list_endpoints(
-                    StatusEquals='InService'
-                )['Endpoints']
-        res.append('InService sagemaker endpoints : {}'.format(len(ep_list)))
-    except botocore.exceptions.ClientError as e:
-        res.append('region-error in {} about {}'.format(region, 'sagemaker endpoint'))
-    return res
 
-def check_comprehend_endpoints(region):
+def check_service(spec, region, role_arn=None):
     """
-    comprehendのendpointが
-    IN_SERVICEならその数を表示する
+    指定サービスの稼働中のリソースの数を表示する
 
     Parameters
     ----------
+    spec : dict()
+        service_registry.SERVICESの要素
     region : string
         AWSのリージョン情報
-    
-    returns
-    -------
-    res : [string]
-        表示文章（サービスごとの稼働数のカウント結果）
-    """
-    client = boto3.Session().client(service_name="comprehend", region_name=region)
-    res = []
-    cnt = 0
-    try:
-        for ep in client.list_endpoints()['EndpointPropertiesList']:
-            if ep['Status'] == 'IN_SERVICE':
-                cnt += 1
-        res.append('IN_SERVICE comprehend endpoints : {}'.format(cnt))
-    except botocore.exceptions.ClientError as e:
-        res.append('region-error in {} about {}'.format(region, 'comprehend endpoint'))
-    return res
+    role_arn : string
+        AssumeRoleするrole ARN（lambda自身のアカウントはNone）
 
-def check_redshift_clusters(region):
-    """
-    redshiftのclusterが
-    ['deleting', 'paused']以外ならその数を表示する
-
-    Parameters
-    ----------
-    region : string
-        AWSのリージョン情報
-    
     returns
     -------
     res : [string]
         表示文章（サービスごとの稼働数のカウント結果）
     """
-    client = boto3.Session().client(service_name="redshift", region_name=region)
     res = []
-    cnt = 0
     try:
-        for clu in client.describe_clusters()['Clusters']:
-            if not clu['ClusterStatus'] in ['deleting', 'paused']:
-                cnt += 1
-        res.append('active redshift endpoints : {}'.format(cnt))
+        client = get_client(spec['service'], region, role_arn)
+        cnt = Counter(name for name, item in list_resources(client, spec))
+        for name in spec['names']:
+            res.append('active {} : {}'.format(name, cnt[name]))
     except botocore.exceptions.ClientError as e:
-        res.append('region-error in {} about {}'.format(region, 'redshift cluster'))
+        res.append('region-error in {} ({}) about {}'.format(region, account_id(role_arn), ', '.join(spec['names'])))
     return res
 
 def check_resources():
     """
-    サービスチェック関数を全リージョンについて実行する
+    service_registry.SERVICESに登録されたサービスについて、
+    サービスチェック関数を全アカウント・全リージョンについて並列に実行する
     """
-    region_result = dict()
-
-    # sagemaker
-    regions = boto3.Session().get_available_regions('sagemaker')
-    # regions = ['eu-west-2']
-    for region in regions:
+    # [account][region] : 表示文章
+    account_result = dict()
+
+    tasks = []
+    for role_arn in get_accounts():
+        for spec in SERVICES:
+            # ec2はcheck_resources_with_ec2.pyで確認する
+            if spec['service'] == 'ec2':
+                continue
+            for region in get_session().get_available_regions(spec['service']):
+                tasks.append((spec, region, role_arn))
+
+    with get_executor(MAX_WORKERS) as executor:
+        futures = [(region, role_arn, executor.submit(check_service, spec, region, role_arn)) for spec, region, role_arn in tasks]
+    # 表示順が実行順に依存しないよう、tasksの順で結果をまとめる
+    for region, role_arn, future in futures:
+        region_result = account_result.setdefault(account_id(role_arn), dict())
         if not region in region_result:
             region_result[region] = []
-        region_result[region] += check_sagemaker_endpoints(region)
-        region_result[region] += check_sagemaker_studios(region)
-        
-    # redshift
-    regions = boto3.Session().get_available_regions('redshift')
-    # regions = ['eu-west-2']
-    for region in regions:
-        if not region in region_result:
-            region_result[region] = []
-        region_result[region] += check_redshift_clusters(region)
-    
-    # comprehend
-    regions = boto3.Session().get_available_regions('comprehend')
-    # regions = ['eu-west-2']
-    for region in regions:
-        if not region in region_result:
-            region_result[region] = []
-        region_result[region] += check_comprehend_endpoints(region)
-    
+        region_result[region] += future.result()
+
     res = []
-    for k,v in region_result.items():
-        res.append(k)
-        res += v
-        res.append('====')
-    
+    for account, region_result in account_result.items():
+        for k,v in region_result.items():
+            res.append('account: {}, region: {}'.format(account, k))
+            res += v
+            res.append('====')
+
     print(*res, sep='\n')
+    print_throttle_counts()
 
+@profile_handler
 def lambda_handler(event, context):
     """
     lambdaが参照する関数
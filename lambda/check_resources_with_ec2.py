@@ -6,16 +6,27 @@ AWS lambdaで必要なタイミングで実行することで、
 ＜設定項目＞
 ■初期設定
 ・タイムアウト時間の延長（10分あれば十分？）
+・（任意）EventBridgeのルールでCloudTrailのイベント（detail-type: AWS API Call via CloudTrail）を
+　このlambdaに送るように設定する。対象のイベントはEVENT_RULESを参照
+　イベントを受けた場合は該当リソースだけインベントリを更新し、全件チェックは行わない
+　（コンテナ間でインベントリを共有するため、INVENTORY_BUCKETの設定と、下記の定期実行の設定が必須）
+　（INVENTORY_BUCKETへはS3の条件付き書き込み（IfMatch）で保存するため、boto3 1.35.69以上が必要。
+　　ランタイム同梱のboto3が古い場合は、新しいboto3をレイヤーで追加する）
+・（任意）EventBridgeによる定期実行の設定（インベントリの全件チェック）
 
 ■更新時設定（初期にも必要）
-・AWS lambdaのコード更新
+・AWS lambdaのコード更新（service_registry.pyも同じ階層に配置する）
 ・role権限の更新
 
 ＜確認対象サービス＞
-・SageMakerStudio（JupyterServer, KernelGateway）
+service_registry.pyのSERVICESに登録されたサービス
+・SageMakerStudio（JupyterServer, KernelGateway, JupyterLab, CodeEditor）
 ・SageMakerEndpoint
+・SageMakerNotebookInstance
 ・RedshiftCluster
+・RedshiftServerless（Workgroup）
 ・ComprehendEndpoint
+・EC2Instance
 
 ＜roleに設定すべきポリシー＞
 ・AWSLambdaBasicExecutionRole
@@ -23,17 +34,73 @@ AWS lambdaで必要なタイミングで実行することで、
 ・AmazonRedshiftFullAccess
 ・ComprehendFullAccess
 ・AmazonEC2FullAccess
+・（ACCOUNT_ROLE_ARNSを使う場合）該当roleへのsts:AssumeRole
+　（AssumeRole先のroleにも上記のポリシーと、このlambdaのroleを信頼するポリシーを設定する）
+・（INVENTORY_BUCKETを使う場合）該当バケットへのs3:GetObject, s3:PutObject
+
+＜環境変数（任意）＞
+・AWS_MAX_ATTEMPTS : API呼び出しの最大試行回数（デフォルト10）
+・MAX_WORKERS : アカウント×リージョンの並列実行数（デフォルト16）
+・ACCOUNT_ROLE_ARNS : 他アカウントもチェックする場合、AssumeRoleするrole ARN（カンマ区切り）
+・INCLUDE_SELF_ACCOUNT : lambda自身のアカウントもチェックするか（デフォルトtrue）
+・INVENTORY_BUCKET : インベントリを保存するS3バケット（未設定なら/tmpにのみ保存し、CloudTrailのイベントは無視する）
+・INVENTORY_KEY : インベントリを保存するS3のキー
+・CHECK_CACHE_TTL : 手動実行時、この秒数以内の全件チェックの結果があればそれを使う（デフォルト300）
+・INSTANCE_TYPE_CACHE_TTL : インスタンスタイプのスペックをキャッシュする秒数（デフォルト7日）
+・RECONCILE_INTERVAL_HOURS : この時間以上全件チェックしていなければ、イベントを受けてもインベントリを更新せずに
+　定期実行の全件チェックを待つ（デフォルト24）
+・PROFILE : trueならlambda_handlerの処理時間とメモリ確保量を計測して表示する
+　（eventに{"profile": true}を指定しても同じ）
+・PROFILE_TOP_N : 計測結果を表示する件数（デフォルト20）
 
 
 """
 
+import os
+import copy
+import time
 import json
+from datetime import datetime, timezone
 import boto3
 import botocore
-
-def get_ec2_instances_info():
+from service_registry import (
+    SERVICES, SAGEMAKER_APP_TYPES, sagemaker_app_id, list_resources,
+    get_accounts, account_id, get_session, get_client, print_throttle_counts, profile_handler, get_executor,
+)
+
+# アカウント×リージョンを並列に確認するときのスレッド数
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', 16))
+# インベントリの保存先（/tmpには常に保存し、INVENTORY_BUCKETが設定されていればS3にも保存）
+INVENTORY_BUCKET = os.environ.get('INVENTORY_BUCKET')
+INVENTORY_KEY = os.environ.get('INVENTORY_KEY', 'check_resources/inventory.json')
+INVENTORY_LOCAL_PATH = '/tmp/inventory.json'
+# インスタンスタイプのスペック（vCPU・メモリ・GPU）のキャッシュ
+INSTANCE_TYPE_CACHE_PATH = '/tmp/instance_types.json'
+INSTANCE_TYPE_CACHE_TTL = float(os.environ.get('INSTANCE_TYPE_CACHE_TTL', 7 * 24 * 3600))
+# 手動実行時、この秒数以内に全件チェックしていればその結果を使う
+CHECK_CACHE_TTL = float(os.environ.get('CHECK_CACHE_TTL', 300))
+# この時間以上全件チェックしていなければ、イベントを受けてもインベントリを更新しない
+RECONCILE_INTERVAL_HOURS = float(os.environ.get('RECONCILE_INTERVAL_HOURS', 24))
+# S3のインベントリの更新が他の実行と競合したときに、読み直してやり直す回数
+INVENTORY_UPDATE_ATTEMPTS = 5
+# 条件付きの保存が他の実行との競合で失敗したときのエラーコード
+CONFLICT_ERROR_CODES = {'PreconditionFailed', 'ConditionalRequestConflict'}
+
+# warmなコンテナで使い回すインベントリ
+_cached_inventory = None
+# warmなコンテナで使い回すインスタンスタイプのスペック
+_instance_type_cache = None
+
+
+def get_ec2_instances_info(account_items=None):
     """
-    全リージョンに対してEC2の稼働状況を取得する
+    全アカウント・全リージョンに対してEC2の稼働状況を取得する
+    インスタンスタイプごとのvCPU・メモリ・GPUから、リージョンごとと全体のキャパシティも集計する
+
+    Parameters
+    ----------
+    account_items : dict()
+        sweep_resources()の結果（Noneならここでec2だけ取得する）
     
     returns
     -------
@@ -43,278 +110,607 @@ def get_ec2_instances_info():
 
     ret = []
 
-    # OptInしないと使えないリージョン
-    optout_regions = ['af-south-1', 'ap-east-1', 'eu-south-1', 'me-south-1']
-    # 指定サービスのregionを取得
-    regions = boto3.Session().get_available_regions('ec2')
+    if account_items is None:
+        account_items = sweep_resources(['ec2 instances'])
+    roles = {account_id(role_arn): role_arn for role_arn in get_accounts()}
+    # (role_arn, region) : 稼働中のインスタンスのリスト
+    results = {
+        (roles[account], region): v['ec2 instances']
+        for account, region_items in account_items.items()
+        for region, v in region_items.items() if v.get('ec2 instances')
+    }
+
+    # 稼働中のインスタンスタイプのスペックを取得（キャッシュにないものだけ）
+    specs = get_instance_type_specs({
+        instance['InstanceType']: target
+        for target, instances in results.items() for instance in instances
+    })
+
+    total = {'vCPU': 0, 'MemoryGiB': 0, 'GPU': 0}
+    for (role_arn, region), instances in results.items():
+        region_total = {'vCPU': 0, 'MemoryGiB': 0, 'GPU': 0}
+        for instance in instances:
+            spec = specs.get(instance['InstanceType'], {'vCPU': 0, 'MemoryGiB': 0, 'GPU': 0})
+            for k in region_total:
+                region_total[k] += spec[k]
+            # 起動からの経過時間（describe_instancesのLaunchTimeから求める）
+            age_hours = (datetime.now(timezone.utc) - instance['LaunchTime']).total_seconds() / 3600
+            ret.append('account : {}, region : {}, InstanceId : {}, InstanceType : {}, vCPU : {}, MemoryGiB : {:.1f}, GPU : {}, Age : {:.1f} hours'.format(
+                account_id(role_arn), region, instance['InstanceId'], instance['InstanceType'],
+                spec['vCPU'], spec['MemoryGiB'], spec['GPU'], age_hours))
+        ret.append('account : {}, region : {}, total vCPU : {}, total MemoryGiB : {:.1f}, total GPU : {}'.format(
+            account_id(role_arn), region, region_total['vCPU'], region_total['MemoryGiB'], region_total['GPU']))
+        for k in total:
+            total[k] += region_total[k]
+    ret.append('total vCPU : {}, total MemoryGiB : {:.1f}, total GPU : {}'.format(total['vCPU'], total['MemoryGiB'], total['GPU']))
+
+    return ret
 
-    # OptInしないと使えないリージョンを除いて検索を実施
-    for region in [i for i in regions if i not in optout_regions]:
-        # if not region in region_result:
-        #     region_result[region] = []
 
-        client = boto3.Session().client(service_name='ec2', region_name=region)
+def get_instance_type_specs(instance_types):
+    """
+    インスタンスタイプごとのvCPU・メモリ・GPUを取得する
+    INSTANCE_TYPE_CACHE_TTLの間はメモリと/tmpにキャッシュし、
+    キャッシュにないインスタンスタイプだけdescribe_instance_typesで取得する
+
+    Parameters
+    ----------
+    instance_types : dict()
+        インスタンスタイプ : 取得に使う(role_arn, region)
+
+    returns
+    -------
+    specs : dict()
+        インスタンスタイプ : {'vCPU', 'MemoryGiB', 'GPU'}
+    """
+    global _instance_type_cache
+    if _instance_type_cache is None:
+        try:
+            with open(INSTANCE_TYPE_CACHE_PATH, 'rb') as f:
+                _instance_type_cache = json.loads(f.read().decode('utf-8'))
+        except FileNotFoundError as e:
+            _instance_type_cache = dict()
+
+    now = time.time()
+    # キャッシュにない（期限切れの）インスタンスタイプを、取得に使う(role_arn, region)ごとにまとめる
+    missing = dict()
+    for instance_type, target in instance_types.items():
+        cached = _instance_type_cache.get(instance_type)
+        if cached is None or now - cached['fetched_at'] >= INSTANCE_TYPE_CACHE_TTL:
+            missing.setdefault(target, []).append(instance_type)
+
+    def describe(target):
+        role_arn, region = target
+        types = missing[target]
+        fetched = dict()
         try:
-            running_instances = client.describe_instances(
-                Filters=[
-                    {
-                        'Name': 'instance-state-name',
-                        'Values': ['running']
+            client = get_client('ec2', region, role_arn)
+            # describe_instance_typesは1回に100件まで
+            for i in range(0, len(types), 100):
+                for info in client.describe_instance_types(InstanceTypes=types[i:i + 100])['InstanceTypes']:
+                    fetched[info['InstanceType']] = {
+                        'vCPU': info['VCpuInfo']['DefaultVCpus'],
+                        'MemoryGiB': info['MemoryInfo']['SizeInMiB'] / 1024,
+                        'GPU': sum(gpu['Count'] for gpu in info.get('GpuInfo', {}).get('Gpus', [])),
+                        'fetched_at': now,
                     }
-                ]
-            )['Reservations']
-
-            for ec2_reservation in running_instances:
-                for ec2_instance in ec2_reservation['Instances']:
-                    ec2_instance_id = ec2_instance['InstanceId']
-                    ec2_instance_type = ec2_instance['InstanceType']
-                    
-                    ret.append('region : {}, InstanceId : {}, InstanceType : {}'.format(region, ec2_instance_id, ec2_instance_type))
-            
         except botocore.exceptions.ClientError as e:
-            print('region-error in {} about {}'.format(region, service_name_text))
+            print('region-error in {} ({}) about {}'.format(region, account_id(role_arn), 'ec2 instance types'))
+        return fetched
 
+    if missing:
+        with get_executor(MAX_WORKERS) as executor:
+            for fetched in executor.map(describe, list(missing)):
+                _instance_type_cache.update(fetched)
+        with open(INSTANCE_TYPE_CACHE_PATH, 'wb') as f:
+            f.write(json.dumps(_instance_type_cache).encode('utf-8'))
 
-    return ret
+    return {k: v for k, v in _instance_type_cache.items() if k in instance_types}
 
 
-def check_ec2_instances(client):
+def check_resources(spec, target_services=None, target_regions=None):
     """
-    ec2の['instances']のうち
-    runningの数を返す
+    指定サービスの全アカウント・全リージョンに対して稼働中のリソースを取得する
 
     Parameters
     ----------
-    client :  boto3.Session().client
-        適切な権限の付与された　service_name="ec2"　のclient
-
+    spec : dict()
+        service_registry.SERVICESの要素
+    target_services : [string]
+        チェックするサービスのservice_name_text（Noneなら全サービス）
+    target_regions : [string]
+        チェックするリージョン（Noneなら全リージョン）
+    
     returns
     -------
-    res : int
-        サービスごとの稼働数のカウント結果
+    account_items : dict()
+        サービスごとの稼働中のリソース
+        [account][region][service_name_text]
     """
 
-    running_instances = client.describe_instances(
-        Filters=[
-            {
-                'Name': 'instance-state-name',
-                'Values': ['running']
-            }
-        ]
-    )['Reservations']
+    account_items = dict()
+    names = [i for i in spec['names'] if target_services is None or i in target_services]
 
-    return len(running_instances)
+    # OptInしないと使えないリージョン
+    optout_regions = ['af-south-1', 'ap-east-1', 'eu-south-1', 'me-south-1']
+    # 指定サービスのregionを取得
+    regions = get_session().get_available_regions(spec['service'])
+    if target_regions is not None:
+        regions = [i for i in regions if i in target_regions]
 
+    def check_region(target):
+        role_arn, region = target
+        try:
+            client = get_client(spec['service'], region, role_arn)
+            return list_resources(client, spec)
+        except botocore.exceptions.ClientError as e:
+            print('region-error in {} ({}) about {}'.format(region, account_id(role_arn), ', '.join(names)))
+            return None
+
+    # OptInしないと使えないリージョンを除いて、アカウント×リージョンで並列に検索を実施
+    targets = [(role_arn, region) for role_arn in get_accounts() for region in regions if region not in optout_regions]
+    with get_executor(MAX_WORKERS) as executor:
+        results = executor.map(check_region, targets)
+    for (role_arn, region), items in zip(targets, results):
+        region_items = account_items.setdefault(account_id(role_arn), dict())
+        region_items[region] = dict()
+        if items is not None:
+            for name in names:
+                region_items[region][name] = []
+            for name, item in items:
+                if name in names:
+                    region_items[region][name].append(item)
+
+
+    return account_items
 
+def deepupdate(dict_base, other):
+  for k, v in other.items():
+    if isinstance(v, dict) and k in dict_base:
+      deepupdate(dict_base[k], v)
+    else:
+      dict_base[k] = v
 
-def check_sagemaker_studios_kernel_gateway(client):
+
+def sweep_resources(target_services=None, target_regions=None):
     """
-    sagemaker studioの['KernelGateway']が
-    InServiceならその数を表示する
+    service_registry.SERVICESに登録された全サービスを、全アカウント・全リージョンについてチェックする
+    （同じ一覧APIは1回だけ呼び出す）
 
     Parameters
     ----------
-    client :  boto3.Session().client
-        適切な権限の付与された　service_name="sagemaker"　のclient
+    target_services : [string]
+        チェックするサービスのservice_name_text（Noneなら全サービス）
+    target_regions : [string]
+        チェックするリージョン（Noneなら全リージョン）
 
     returns
     -------
-    cnt : int
-        サービスごとの稼働数のカウント結果
+    account_items : dict()
+        サービスごとの稼働中のリソース
+        [account][region][service_name_text]
     """
-    cnt = 0
+    account_items = dict()
 
-    for app in client.list_apps()['Apps']:
-        if app['Status']=='InService' and app['AppType'] in ['KernelGateway']:
-            cnt += 1
+    specs = [spec for spec in SERVICES if target_services is None or set(spec['names']) & set(target_services)]
+    # サービスごとのチェックも並列に実行する
+    with get_executor(len(specs) or 1) as executor:
+        results = list(executor.map(lambda spec: check_resources(spec, target_services, target_regions), specs))
+    for result in results:
+        deepupdate(account_items, result)
 
-    return cnt
+    return account_items
 
 
-def check_sagemaker_studios_jupyter_server(client):
+def to_resource_ids(account_items):
     """
-    sagemaker studioの['JupyterServer']が
-    InServiceならその数を表示する
+    sweep_resources()の結果をリソースIDに変換する
 
     Parameters
     ----------
-    client :  boto3.Session().client
-        適切な権限の付与された　service_name="sagemaker"　のclient
+    account_items : dict()
+        サービスごとの稼働中のリソース
+        [account][region][service_name_text]
 
     returns
     -------
-    cnt : int
-        サービスごとの稼働数のカウント結果
+    account_result : dict()
+        サービスごとの稼働中のリソースID
+        [account][region][service_name_text]
     """
-    cnt = 0
-
-    for app in client.list_apps()['Apps']:
-        if app['Status']=='InService' and app['AppType'] in ['JupyterServer']:
-            cnt += 1
-
-    return cnt
+    ids_of = {name: spec['id'] for spec in SERVICES for name in spec['names']}
+    return {
+        account: {
+            region: {name: [ids_of[name](i) for i in items] for name, items in v.items()}
+            for region, v in region_items.items()
+        }
+        for account, region_items in account_items.items()
+    }
 
 
-def check_sagemaker_endpoints(client):
+def check_all_resources(target_services=None, target_regions=None):
     """
-    sagemaker studioのendpointが
-    InServiceならその数を返す
+    サービスチェック関数を全アカウント・全リージョンについて実行する
 
     Parameters
     ----------
-    client :  boto3.Session().client
-        適切な権限の付与された　service_name="sagemaker"　のclient
+    target_services : [string]
+        チェックするサービスのservice_name_text（Noneなら全サービス）
+    target_regions : [string]
+        チェックするリージョン（Noneなら全リージョン）
 
     returns
     -------
-    res : int
-        サービスごとの稼働数のカウント結果
+    account_result : dict()
+        サービスごとの稼働中のリソースID
+        [account][region][service_name_text]
     """
-    
-    ep_list = client.list_endpoints(
-                StatusEquals='InService'
-            )['Endpoints']
+    return to_resource_ids(sweep_resources(target_services, target_regions))
 
-    return len(ep_list)
 
-def check_comprehend_endpoints(client):
+def print_account_result(account_result):
     """
-    comprehendのendpointが
-    IN_SERVICEならその数を表示する
+    稼働中のリソースがあるサービスについて、アカウント・リージョンごとに稼働数を表示する
 
     Parameters
     ----------
-    client :  boto3.Session().client
-        適切な権限の付与された　service_name="comprehend"　のclient
+    account_result : dict()
+        サービスごとの稼働中のリソースID
+        [account][region][service_name_text]
+    """
+    res = []
+    print_flag = False
+    for account, region_result in account_result.items():
+        for region, v in region_result.items():
+            for service, ids in v.items():
+                if len(ids) > 0:
+                    if not print_flag:
+                        res.append('account: {}, region: {}'.format(account, region))
+                    res.append('  {} : {}'.format(service, len(ids)))
+                    print_flag = True
+            if print_flag:
+                res.append('====')
+                print_flag = False
     
+    print(*res, sep='\n')
+
+
+def load_inventory():
+    """
+    INVENTORY_BUCKETに保存済みのインベントリを読み込む
+
     returns
     -------
-    res : int
-        サービスごとの稼働数のカウント結果
+    inventory : dict()
+        'resources'（[account][region][service_name_text]の稼働中のリソースID）と
+        'reconciled_at'（最後に全件チェックした時刻, UNIX時間）、
+        'ec2_report'（全件チェック時のget_ec2_instances_info()の結果）を持つ辞書
+        保存済みのものがなければNone
+    etag : string
+        読み込んだオブジェクトのETag（save_inventory()で条件付きで保存するときに使う）
+    """
+    try:
+        response = get_client('s3', None).get_object(Bucket=INVENTORY_BUCKET, Key=INVENTORY_KEY)
+    except botocore.exceptions.ClientError as e:
+        return None, None
+    return json.loads(response['Body'].read().decode('utf-8')), response['ETag']
+
+
+def save_inventory(inventory, etag=None):
+    """
+    インベントリを保存する
+    INVENTORY_BUCKETが設定されていればS3に保存し、メモリと/tmpには常に保存する
+
+    Parameters
+    ----------
+    inventory : dict()
+        load_inventory()と同じ形式の辞書
+    etag : string
+        load_inventory()で読み込んだときのETag。指定すると、その後に他の実行が
+        書き込んでいない場合だけ保存する（書き込まれていればClientErrorを送出する）
     """
+    global _cached_inventory
+    body = json.dumps(inventory).encode('utf-8')
+    # S3への保存に失敗したときに、メモリと/tmpだけ更新されないよう先に保存する
+    if INVENTORY_BUCKET:
+        condition = {'IfMatch': etag} if etag is not None else {}
+        get_client('s3', None).put_object(Bucket=INVENTORY_BUCKET, Key=INVENTORY_KEY, Body=body, **condition)
+    _cached_inventory = inventory
+    with open(INVENTORY_LOCAL_PATH, 'wb') as f:
+        f.write(body)
+
+
+def get_cached_inventory():
+    """
+    CHECK_CACHE_TTL以内に全件チェックしたインベントリがあれば、リソースをチェックせずに返す
+    INVENTORY_BUCKETが設定されていれば、他のコンテナがイベントで更新した分も見えるようS3から、
+    なければwarmなコンテナならメモリから、それ以外は/tmpから読み込む
 
-    cnt = 0
-    for ep in client.list_endpoints()['EndpointPropertiesList']:
-        if ep['Status'] == 'IN_SERVICE':
-            cnt += 1
+    returns
+    -------
+    inventory : dict()
+        load_inventory()と同じ形式の辞書
+        有効なキャッシュがなければNone
+    """
+    global _cached_inventory
+    if INVENTORY_BUCKET:
+        inventory, etag = load_inventory()
+        if inventory is None or time.time() - inventory['reconciled_at'] >= CHECK_CACHE_TTL:
+            return None
+        return inventory
+    if _cached_inventory is None:
+        try:
+            with open(INVENTORY_LOCAL_PATH, 'rb') as f:
+                _cached_inventory = json.loads(f.read().decode('utf-8'))
+        except FileNotFoundError as e:
+            return None
+    if time.time() - _cached_inventory['reconciled_at'] >= CHECK_CACHE_TTL:
+        return None
+    return _cached_inventory
 
-    return cnt
 
-def check_redshift_clusters(client):
+def reconcile_inventory(account_items=None):
     """
-    redshiftのclusterが
-    ['deleting', 'paused']以外ならその数を表示する
+    全リージョン・全サービスをチェックしてインベントリを作り直す
+    キャッシュを使ったときも同じ内容を表示できるよう、EC2の詳細表示もあわせて保存する
 
     Parameters
     ----------
-    client :  boto3.Session().client
-        適切な権限の付与された　service_name="redshift"　のclient
-    
+    account_items : dict()
+        sweep_resources()の結果（Noneならここでチェックする）
+
     returns
     -------
-    res : int
-        サービスごとの稼働数のカウント結果
+    inventory : dict()
+        load_inventory()と同じ形式の辞書
     """
+    if account_items is None:
+        account_items = sweep_resources()
+    inventory = {
+        'resources': to_resource_ids(account_items),
+        'reconciled_at': time.time(),
+        'ec2_report': get_ec2_instances_info(account_items),
+    }
+    save_inventory(inventory)
+    return inventory
 
-    cnt = 0
-    
-    for clu in client.describe_clusters()['Clusters']:
-        if not clu['ClusterStatus'] in ['deleting', 'paused']:
-            cnt += 1
-        
-    return cnt
 
+def refresh_inventory(inventory, account_items):
+    """
+    指定したサービス・リージョンだけチェックし直した結果でインベントリを更新する
+    INVENTORY_BUCKETが設定されていれば、他の実行がイベントで反映した分を消さないよう
+    update_shared_inventory()でS3のものを読み直して更新する
 
-def check_resources(service_name, service_name_text, func):
+    Parameters
+    ----------
+    inventory : dict()
+        load_inventory()と同じ形式の辞書
+    account_items : dict()
+        チェックし直したサービス・リージョンのsweep_resources()の結果
+
+    returns
+    -------
+    inventory : dict()
+        更新後のインベントリ（S3のインベントリを更新できなければNone）
+    """
+    resources = to_resource_ids(account_items)
+
+    def update(target):
+        # 一部だけのチェックなのでreconciled_atとec2_reportは更新しない
+        deepupdate(target['resources'], copy.deepcopy(resources))
+        return True
+
+    if INVENTORY_BUCKET:
+        return update_shared_inventory(update)
+    # キャッシュしているものは書き換えずに、コピーを更新して保存する
+    inventory = copy.deepcopy(inventory)
+    update(inventory)
+    save_inventory(inventory)
+    return inventory
+
+
+def _instance_ids(elements):
+    # RunInstances等のinstancesSetからインスタンスIDを取り出す
+    return [i['instanceId'] for i in (elements or {}).get('instancesSet', {}).get('items', [])]
+
+
+def _sagemaker_app_event(detail):
+    # CreateApp/DeleteAppのイベントから(service_name_text, [ID])を取り出す
+    params = detail['requestParameters']
+    service_name_text = SAGEMAKER_APP_TYPES.get(params.get('appType'))
+    if service_name_text is None:
+        return None, []
+    return service_name_text, [sagemaker_app_id(params['domainId'], params.get('userProfileName', params.get('spaceName')), params['appName'])]
+
+
+# CloudTrailのイベントごとのインベントリの更新方法
+# (eventSource, eventName) : (操作, detailから(service_name_text, [ID])を取り出す関数)
+# 操作は'add'なら稼働中として追加、'remove'なら稼働中から削除
+EVENT_RULES = {
+    ('sagemaker.amazonaws.com', 'CreateApp'): ('add', _sagemaker_app_event),
+    ('sagemaker.amazonaws.com', 'DeleteApp'): ('remove', _sagemaker_app_event),
+    ('sagemaker.amazonaws.com', 'CreateEndpoint'): ('add', lambda d: ('sagemaker_endpoints', [d['requestParameters']['endpointName']])),
+    ('sagemaker.amazonaws.com', 'DeleteEndpoint'): ('remove', lambda d: ('sagemaker_endpoints', [d['requestParameters']['endpointName']])),
+    ('sagemaker.amazonaws.com', 'CreateNotebookInstance'): ('add', lambda d: ('sagemaker_notebook_instances', [d['requestParameters']['notebookInstanceName']])),
+    ('sagemaker.amazonaws.com', 'StartNotebookInstance'): ('add', lambda d: ('sagemaker_notebook_instances', [d['requestParameters']['notebookInstanceName']])),
+    ('sagemaker.amazonaws.com', 'StopNotebookInstance'): ('remove', lambda d: ('sagemaker_notebook_instances', [d['requestParameters']['notebookInstanceName']])),
+    ('sagemaker.amazonaws.com', 'DeleteNotebookInstance'): ('remove', lambda d: ('sagemaker_notebook_instances', [d['requestParameters']['notebookInstanceName']])),
+    ('redshift.amazonaws.com', 'CreateCluster'): ('add', lambda d: ('redshift_clusters', [d['requestParameters']['clusterIdentifier']])),
+    ('redshift.amazonaws.com', 'ResumeCluster'): ('add', lambda d: ('redshift_clusters', [d['requestParameters']['clusterIdentifier']])),
+    ('redshift.amazonaws.com', 'PauseCluster'): ('remove', lambda d: ('redshift_clusters', [d['requestParameters']['clusterIdentifier']])),
+    ('redshift.amazonaws.com', 'DeleteCluster'): ('remove', lambda d: ('redshift_clusters', [d['requestParameters']['clusterIdentifier']])),
+    ('redshift-serverless.amazonaws.com', 'CreateWorkgroup'): ('add', lambda d: ('redshift_serverless_workgroups', [d['requestParameters']['workgroupName']])),
+    ('redshift-serverless.amazonaws.com', 'DeleteWorkgroup'): ('remove', lambda d: ('redshift_serverless_workgroups', [d['requestParameters']['workgroupName']])),
+    ('comprehend.amazonaws.com', 'CreateEndpoint'): ('add', lambda d: ('comprehend_endpoints', [d['responseElements']['endpointArn']])),
+    ('comprehend.amazonaws.com', 'DeleteEndpoint'): ('remove', lambda d: ('comprehend_endpoints', [d['requestParameters']['endpointArn']])),
+    ('ec2.amazonaws.com', 'RunInstances'): ('add', lambda d: ('ec2 instances', _instance_ids(d['responseElements']))),
+    ('ec2.amazonaws.com', 'StartInstances'): ('add', lambda d: ('ec2 instances', _instance_ids(d['requestParameters']))),
+    ('ec2.amazonaws.com', 'StopInstances'): ('remove', lambda d: ('ec2 instances', _instance_ids(d['requestParameters']))),
+    ('ec2.amazonaws.com', 'TerminateInstances'): ('remove', lambda d: ('ec2 instances', _instance_ids(d['requestParameters']))),
+}
+
+
+def apply_cloudtrail_event(inventory, account, detail):
     """
-    指定サービスの全リージョンに対してサービス稼働数を取得する
+    CloudTrailのイベント1件分だけインベントリを更新する
 
     Parameters
     ----------
-    service_name : string
-        AWSのサービス名　boto3.Session().clientのservice_nameに引き渡す
-    service_name_text : string
-        文字列を出力するときのサービス名
-    func : string
-        service実行件数を取得するための関数名
-    
+    inventory : dict()
+        load_inventory()と同じ形式の辞書
+    account : string
+        イベントが発生したアカウントID
+    detail : dict()
+        EventBridgeのイベントのdetail
+
     returns
     -------
-    region_result : dict()
-        サービスごとの稼働数のカウント結果
-        [region][service_name_text]
+    updated : bool
+        インベントリを更新したかどうか
     """
+    rule = EVENT_RULES.get((detail.get('eventSource'), detail.get('eventName')))
+    # 対象外のイベントや、失敗したAPI呼び出しは無視する
+    if rule is None or 'errorCode' in detail:
+        return False
+    op, extract = rule
+    service_name_text, ids = extract(detail)
+    if service_name_text is None or not ids:
+        return False
+
+    region_resources = inventory['resources'].setdefault(account, dict()).setdefault(detail['awsRegion'], dict())
+    current = set(region_resources.get(service_name_text, []))
+    if op == 'add':
+        current.update(ids)
+    else:
+        current.difference_update(ids)
+    region_resources[service_name_text] = sorted(current)
+    print('{} {} {} in {} ({})'.format(op, service_name_text, ', '.join(ids), detail['awsRegion'], account))
+    return True
 
-    region_result = dict()
 
-    # OptInしないと使えないリージョン
-    optout_regions = ['af-south-1', 'ap-east-1', 'eu-south-1', 'me-south-1']
-    # 指定サービスのregionを取得
-    regions = boto3.Session().get_available_regions(service_name)
+def update_shared_inventory(update):
+    """
+    INVENTORY_BUCKETのインベントリを読み込んで更新する
+    同時に実行された他のlambdaと上書きし合わないよう、読み込んだときのETagを条件に保存し、
+    他の実行と競合したら読み直してやり直す
+    インベントリがないか、RECONCILE_INTERVAL_HOURS以上全件チェックしていなければ、
+    ここでは全件チェックせずに定期実行に任せる
 
-    # OptInしないと使えないリージョンを除いて検索を実施
-    for region in [i for i in regions if i not in optout_regions]:
-        if not region in region_result:
-            region_result[region] = dict()
+    Parameters
+    ----------
+    update : function
+        読み込んだインベントリを書き換える関数（書き換えなければFalseを返す）
 
-        client = boto3.Session().client(service_name=service_name, region_name=region)
+    returns
+    -------
+    inventory : dict()
+        更新後のインベントリ（更新できなければNone）
+    """
+    # 古いboto3ではIfMatchを指定するとClientErrorではなくParamValidationErrorになるので、先に確認する
+    if 'IfMatch' not in get_client('s3', None).meta.service_model.operation_model('PutObject').input_shape.members:
+        print('boto3 {} does not support conditional writes to S3, skip the update (1.35.69 or later is required)'.format(boto3.__version__))
+        return None
+    for i in range(INVENTORY_UPDATE_ATTEMPTS):
+        inventory, etag = load_inventory()
+        if inventory is None or time.time() - inventory['reconciled_at'] >= RECONCILE_INTERVAL_HOURS * 3600:
+            print('inventory is missing or stale, skip the update until the scheduled check')
+            return None
+        if not update(inventory):
+            return inventory
         try:
-            region_result[region][service_name_text] = func(client)
-            
+            save_inventory(inventory, etag)
+            return inventory
         except botocore.exceptions.ClientError as e:
-            print('region-error in {} about {}'.format(region, service_name_text))
+            if e.response['Error']['Code'] not in CONFLICT_ERROR_CODES:
+                raise
+            print('inventory was updated by another invocation, reload and retry')
+    print('gave up updating the inventory after {} attempts'.format(INVENTORY_UPDATE_ATTEMPTS))
+    return None
 
 
-    return region_result
+def update_inventory_on_event(account, detail):
+    """
+    CloudTrailのイベント1件分をINVENTORY_BUCKETのインベントリに反映する
+
+    Parameters
+    ----------
+    account : string
+        イベントが発生したアカウントID
+    detail : dict()
+        EventBridgeのイベントのdetail
+
+    returns
+    -------
+    inventory : dict()
+        更新後のインベントリ（反映できなければNone）
+    """
+    return update_shared_inventory(lambda inventory: apply_cloudtrail_event(inventory, account, detail))
 
-def deepupdate(dict_base, other):
-  for k, v in other.items():
-    if isinstance(v, dict) and k in dict_base:
-      deepupdate(dict_base[k], v)
-    else:
-      dict_base[k] = v
 
-def check_all_resources():
+def is_cloudtrail_event(event):
     """
-    サービスチェック関数を全リージョンについて実行する
+    EventBridge経由のCloudTrailのイベントかどうか
     """
-    region_result = dict()
-    
-    # sagemaker
-    deepupdate(region_result, check_resources('sagemaker', 'sagemaker_kernel_gateway', check_sagemaker_studios_kernel_gateway))
-    deepupdate(region_result, check_resources('sagemaker', 'sagemaker_jupyter_server', check_sagemaker_studios_jupyter_server))
-    # redshift
-    deepupdate(region_result, check_resources('redshift', 'redshift_clusters', check_redshift_clusters))
-    # redshift
-    deepupdate(region_result, check_resources('comprehend', 'comprehend_endpoints', check_comprehend_endpoints))
-    # ec2
-    deepupdate(region_result, check_resources('ec2', 'ec2 instances', check_ec2_instances))
-
-    # 出力
-    res = []
-    print_flag = False
-    for region, v in region_result.items():
-        for service, cnt in v.items():
-            if cnt > 0: 
-                if not False:
-                    res.append('region: {}'.format(region))
-                res.append('  {} : {}'.format(service, cnt))
-                print_flag = True
-        if print_flag:
-            res.append('====')
-            print_flag = False
-    
-    print(*res, sep='\n')
-    
-    
+    return isinstance(event, dict) and event.get('detail-type') == 'AWS API Call via CloudTrail'
+
+
+@profile_handler
 def lambda_handler(event, context):
     """
     lambdaが参照する関数
     （lambda_handler(event, context)の形で設定する必要がある）
-    check_resources()を実行するだけ
+    CloudTrailのイベントなら該当リソースだけS3のインベントリを更新し、
+    それ以外（定期実行・手動実行）は全件チェックする
+    （インベントリがない・古い場合も、イベントでは全件チェックせずに定期実行に任せる）
+    手動実行でCHECK_CACHE_TTL以内のインベントリがあれば、AWSにアクセスせずにそれを表示する
+    （EC2の詳細表示は、そのインベントリを作った全件チェック時点のもの）
+
+    eventに下記を指定すると手動実行時の動作を変えられる
+    ・'refresh' : trueならキャッシュを使わずに全件チェックする
+    ・'services' : 指定したservice_name_textのサービスだけチェックし直す
+    ・'regions' : 指定したリージョンだけチェックし直す
+    　（services, regionsを指定したときは、キャッシュがなくても指定分だけチェックする。
+    　　キャッシュがなければインベントリは保存せず、チェックした分だけ表示する）
     """
-    check_all_resources()
-    print(*get_ec2_instances_info(), sep='\n')
+    inventory = None
+    if is_cloudtrail_event(event):
+        # /tmpはコンテナごとなので、イベントの反映には共有のS3が必要
+        if not INVENTORY_BUCKET:
+            print('INVENTORY_BUCKET is not set, skip the event')
+        else:
+            inventory = update_inventory_on_event(event['account'], event['detail'])
+            if inventory is not None:
+                print_account_result(inventory['resources'])
+        print_throttle_counts()
+        print('all done')
+        return {
+            'statusCode': 200,
+            'body': json.dumps('Success!')
+        }
+    if not event.get('refresh') and event.get('detail-type') != 'Scheduled Event':
+        services, regions = event.get('services'), event.get('regions')
+        inventory = get_cached_inventory()
+        if services or regions:
+            account_items = sweep_resources(services, regions)
+            if services is None or 'ec2 instances' in services:
+                print(*get_ec2_instances_info(account_items), sep='\n')
+            if inventory is not None:
+                inventory = refresh_inventory(inventory, account_items)
+            if inventory is None:
+                # 全件チェックではないので、インベントリは保存せずにチェックした分だけ表示する
+                print('no cached inventory, show only the given services and regions')
+                inventory = {'resources': to_resource_ids(account_items)}
+        elif inventory is not None:
+            print('use cached inventory ({:.0f} seconds old)'.format(time.time() - inventory['reconciled_at']))
+            print(*inventory.get('ec2_report', []), sep='\n')
+
+    if inventory is None:
+        # ec2の詳細表示にも同じ結果を使い、describe_instancesを重複して呼ばない
+        inventory = reconcile_inventory(sweep_resources())
+        print(*inventory['ec2_report'], sep='\n')
+
+    print_account_result(inventory['resources'])
+    print_throttle_counts()
     print('all done')
     return {
         'statusCode': 200,
@@ -322,4 +718,4 @@ def lambda_handler(event, context):
     }
 
 if __name__ == '__main__':
-    check_all_resources()
+    print_account_result(check_all_resources())
@@ -0,0 +1,511 @@
+"""
+稼働状況の確認（check_resources*.py）と自動停止（stop_resources.py）の対象サービスを
+まとめて定義するためのモジュールです。
+lambdaで利用するときは、lambda_function.pyと同じ階層にservice_registry.pyとして配置してください。
+
+＜サービスの追加方法＞
+SERVICESに下記のキーを持つ辞書を追加する
+・service : boto3.Session().clientのservice_name
+・operation : 一覧を取得するAPI（paginatorが使えるもの）
+・params : operationに渡す引数
+・items : 各ページからリソースを取り出すJMESPath
+・names : 出力するときのサービス名（service_name_text）のリスト
+・name_of : リソースからnamesのどれに当たるかを返す関数（namesが1つなら不要。Noneなら対象外）
+・active : 稼働中（確認・停止の対象）かどうかを返す関数
+・id : リソースを一意に識別するIDを返す関数
+・created : 作成（起動）時刻を返す関数
+・stop : (client, リソース)を受け取って停止する関数（Noneなら確認のみ）
+・tags : (client, リソース)を受け取ってタグを{Key: Value}で返す関数（Noneならタグによる停止回避なし）
+
+＜共通処理＞
+各lambdaで共通して使う、下記の処理もこのモジュールにまとめている
+・get_session, get_client : アカウントごとに共有するsessionと、(account, service, region)ごとに共有する、リトライ設定済みのclient
+・get_accounts, account_id : ACCOUNT_ROLE_ARNS, INCLUDE_SELF_ACCOUNTによるチェック対象のアカウント
+・print_throttle_counts : スロットリングの発生回数の表示
+・profile_handler, get_executor : PROFILEによるlambda_handlerの計測と、計測中も中身を計測できる並列実行
+"""
+
+import os
+import time
+import threading
+from collections import Counter
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from functools import partial, wraps
+import boto3
+import botocore
+from botocore.config import Config
+
+# adaptiveモードでスロットリング時にクライアント側で送信レートを下げてリトライする
+RETRY_CONFIG = Config(retries={
+    'total_max_attempts': int(os.environ.get('AWS_MAX_ATTEMPTS', 10)),
+    'mode': 'adaptive',
+})
+# チェック対象の他アカウントのrole ARN（カンマ区切り）
+ACCOUNT_ROLE_ARNS = [i.strip() for i in os.environ.get('ACCOUNT_ROLE_ARNS', '').split(',') if i.strip()]
+# lambda自身のアカウントもチェック対象にするか
+INCLUDE_SELF_ACCOUNT = os.environ.get('INCLUDE_SELF_ACCOUNT', 'true').lower() == 'true'
+ASSUME_ROLE_SESSION_NAME = 'ds-on-aws-resources'
+# 一時認証情報の有効期限がこの秒数を切ったら取り直す
+CREDENTIALS_REFRESH_MARGIN = 300
+# trueならlambda_handlerをcProfileとtracemallocで計測する
+PROFILE = os.environ.get('PROFILE', 'false').lower() == 'true'
+PROFILE_TOP_N = int(os.environ.get('PROFILE_TOP_N', 20))
+# スロットリングとみなすエラーコード
+THROTTLE_ERROR_CODES = {
+    'Throttling', 'ThrottlingException', 'ThrottledException',
+    'RequestThrottledException', 'TooManyRequestsException',
+    'RequestLimitExceeded', 'RequestThrottled', 'SlowDown',
+}
+
+# (account, service_name, region)ごとのclient。adaptiveモードのトークンバケットはclient単位なので
+# 同じclientを使い回すことで、同じ(account, service, region)への呼び出しが1つのレート制限を共有する
+_clients = dict()
+_clients_lock = threading.Lock()
+# (account, service_name, region)ごとのスロットリング発生回数
+throttle_counts = Counter()
+# role ARNごとのAssumeRoleで取得した一時認証情報
+_credentials = dict()
+_credentials_lock = threading.Lock()
+# role ARN（lambda自身のアカウントはNone）ごとの(session, 作成に使った一時認証情報)
+_sessions = dict()
+_sessions_lock = threading.Lock()
+# lambda自身のアカウントID
+_self_account_id = None
+# profile_handlerで計測中かどうか
+_profiling = False
+
+
+# sagemaker studioのAppTypeとservice_name_textの対応
+SAGEMAKER_APP_TYPES = {
+    'KernelGateway': 'sagemaker_kernel_gateway',
+    'JupyterServer': 'sagemaker_jupyter_server',
+    'JupyterLab': 'sagemaker_jupyter_lab',
+    'CodeEditor': 'sagemaker_code_editor',
+}
+
+
+def sagemaker_app_id(domain_id, user_profile_name, app_name):
+    """
+    sagemaker studioのappを一意に識別するIDを作る
+    （list_appsの結果とCloudTrailのイベントで同じIDになるようにする）
+    """
+    return '{}/{}/{}'.format(domain_id, user_profile_name, app_name)
+
+
+def _count_throttle(key, response=None, **kwargs):
+    """
+    needs-retryイベントのハンドラ。スロットリングのエラーなら回数を数える
+    （Noneを返すのでリトライ判定には影響しない）
+    """
+    if response is None:
+        return None
+    code = response[1].get('Error', {}).get('Code')
+    if code in THROTTLE_ERROR_CODES:
+        with _clients_lock:
+            throttle_counts[key] += 1
+    return None
+
+
+def get_accounts():
+    """
+    チェック対象のアカウントを返す
+
+    returns
+    -------
+    accounts : [string]
+        AssumeRoleするrole ARN（lambda自身のアカウントはNone）
+    """
+    accounts = [None] if INCLUDE_SELF_ACCOUNT else []
+    return accounts + ACCOUNT_ROLE_ARNS
+
+
+def account_id(role_arn):
+    """
+    role ARNからアカウントIDを取得する
+
+    Parameters
+    ----------
+    role_arn : string
+        AssumeRoleするrole ARN（lambda自身のアカウントはNone）
+
+    returns
+    -------
+    account_id : string
+        アカウントID
+    """
+    global _self_account_id
+    if role_arn is not None:
+        # arn:aws:iam::<account_id>:role/<role_name>
+        return role_arn.split(':')[4]
+    if _self_account_id is None:
+        _self_account_id = get_session().client('sts').get_caller_identity()['Account']
+    return _self_account_id
+
+
+def get_credentials(role_arn):
+    """
+    AssumeRoleで一時認証情報を取得する
+    有効期限が切れるまではキャッシュしたものを返す
+
+    Parameters
+    ----------
+    role_arn : string
+        AssumeRoleするrole ARN
+
+    returns
+    -------
+    credentials : dict()
+        assume_roleのレスポンスの['Credentials']
+    """
+    with _credentials_lock:
+        credentials = _credentials.get(role_arn)
+        # 期限切れ間際のものは使わずに取り直す
+        if credentials is None or credentials['Expiration'].timestamp() - time.time() < CREDENTIALS_REFRESH_MARGIN:
+            credentials = get_client('sts', None).assume_role(
+                RoleArn=role_arn,
+                RoleSessionName=ASSUME_ROLE_SESSION_NAME,
+            )['Credentials']
+            _credentials[role_arn] = credentials
+        return credentials
+
+
+def get_session(role_arn=None):
+    """
+    アカウントごとに共有するsessionを取得する
+    （Sessionはそれぞれサービスモデルを読み込み直すので、clientは同じsessionから作る）
+
+    Parameters
+    ----------
+    role_arn : string
+        AssumeRoleするrole ARN（lambda自身のアカウントはNone）
+
+    returns
+    -------
+    session : boto3.Session
+        該当アカウントの認証情報を持つsession
+    """
+    credentials = get_credentials(role_arn) if role_arn is not None else None
+    with _sessions_lock:
+        session, session_credentials = _sessions.get(role_arn, (None, None))
+        # 認証情報が更新されていればsessionも作り直す
+        if session is None or session_credentials is not credentials:
+            if credentials is None:
+                session = boto3.Session()
+            else:
+                session = boto3.Session(
+                    aws_access_key_id=credentials['AccessKeyId'],
+                    aws_secret_access_key=credentials['SecretAccessKey'],
+                    aws_session_token=credentials['SessionToken'],
+                )
+            # botocoreのsessionは内部の部品（認証情報・エンドポイント等）を最初のclient生成時に作るので、
+            # 複数スレッドから同時にclientを作る前に、ロック内で1つ作っておく
+            session.client('sts', config=RETRY_CONFIG)
+            _sessions[role_arn] = (session, credentials)
+        return session
+
+
+def get_client(service_name, region, role_arn=None):
+    """
+    (account, service_name, region)ごとに共有するclientを取得する
+
+    Parameters
+    ----------
+    service_name : string
+        AWSのサービス名
+    region : string
+        AWSのリージョン情報
+    role_arn : string
+        AssumeRoleするrole ARN（lambda自身のアカウントはNone）
+
+    returns
+    -------
+    client : boto3.Session().client
+        リトライ設定済みのclient
+    """
+    key = (account_id(role_arn), service_name, region)
+    session = get_session(role_arn)
+    with _clients_lock:
+        client, client_session = _clients.get(key, (None, None))
+    if client is not None and client_session is session:
+        return client
+
+    # clientの生成は時間がかかるので、ロックの外で並列に行う
+    client = session.client(service_name=service_name, region_name=region, config=RETRY_CONFIG)
+    client.meta.events.register('needs-retry', partial(_count_throttle, key))
+    with _clients_lock:
+        # 他のスレッドが先に同じclientを作っていれば、そちらに揃える
+        client_session = _clients.get(key, (None, None))[1]
+        if client_session is not session:
+            _clients[key] = (client, session)
+        return _clients[key][0]
+
+
+def print_throttle_counts():
+    """
+    スロットリングが発生した(account, service, region)とその回数を表示する
+    """
+    for (account, service_name, region), cnt in sorted(throttle_counts.items()):
+        print('throttled {} in {} ({}) : {}'.format(service_name, region, account, cnt))
+
+
+class _InlineExecutor(Executor):
+    """
+    計測中に使うexecutor。スレッドを使わずに、呼び出したスレッドで順番に実行する
+    """
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+
+def get_executor(max_workers):
+    """
+    並列実行に使うexecutorを取得する
+    cProfileは呼び出したスレッドしか計測できないので、profile_handlerで計測中は
+    ワーカースレッドを使わずに、計測しているスレッドで順番に実行するexecutorを返す
+
+    Parameters
+    ----------
+    max_workers : int
+        並列実行数
+
+    returns
+    -------
+    executor : concurrent.futures.Executor
+        ThreadPoolExecutor（計測中は_InlineExecutor）
+    """
+    if _profiling:
+        return _InlineExecutor()
+    return ThreadPoolExecutor(max_workers=max_workers)
+
+
+def profile_handler(handler):
+    """
+    PROFILEがtrue、またはeventに{"profile": true}が指定されたときだけ、
+    handlerをcProfileとtracemallocで計測して上位PROFILE_TOP_N件を表示する
+    （計測中はget_executor()がスレッドを使わずに順番に実行するので、並列処理の中身も計測できる。
+    　そのかわり処理時間は並列実行時より長くなる）
+
+    Parameters
+    ----------
+    handler : function
+        lambda_handler(event, context)
+
+    returns
+    -------
+    wrapper : function
+        計測付きのhandler
+    """
+    @wraps(handler)
+    def wrapper(event, context):
+        if not (PROFILE or (isinstance(event, dict) and event.get('profile'))):
+            return handler(event, context)
+
+        # 計測しないときのコストを無くすため、ここでimportする
+        import cProfile
+        import pstats
+        import tracemalloc
+
+        global _profiling
+        tracemalloc.start()
+        profiler = cProfile.Profile()
+        _profiling = True
+        try:
+            return profiler.runcall(handler, event, context)
+        finally:
+            _profiling = False
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+
+            # 累積時間の上位の関数
+            stats = pstats.Stats(profiler).stats
+            print('profile: top {} functions by cumulative time'.format(PROFILE_TOP_N))
+            for (filename, lineno, funcname), (cc, nc, tt, ct, callers) in sorted(stats.items(), key=lambda i: i[1][3], reverse=True)[:PROFILE_TOP_N]:
+                print('  {:8.3f}s {:8.3f}s {:>7} {}:{}({})'.format(ct, tt, nc, os.path.basename(filename), lineno, funcname))
+            # メモリ確保量の上位の箇所
+            print('profile: top {} allocation sites'.format(PROFILE_TOP_N))
+            for stat in snapshot.statistics('lineno')[:PROFILE_TOP_N]:
+                frame = stat.traceback[0]
+                print('  {:10.1f}KiB {:>7} {}:{}'.format(stat.size / 1024, stat.count, os.path.basename(frame.filename), frame.lineno))
+    return wrapper
+
+
+def _delete_sagemaker_app(client, app):
+    # UserProfileNameかSpaceNameのどちらかに紐づいている
+    owner = {'UserProfileName': app['UserProfileName']} if 'UserProfileName' in app else {'SpaceName': app['SpaceName']}
+    return client.delete_app(
+        DomainId = app['DomainId'],
+        AppType = app['AppType'],
+        AppName = app['AppName'],
+        **owner
+    )
+
+
+def _sagemaker_tags(client, arn):
+    return {t['Key']: t['Value'] for t in client.list_tags(ResourceArn=arn)['Tags']}
+
+
+def _comprehend_tags(client, arn):
+    return {t['Key']: t['Value'] for t in client.list_tags_for_resource(ResourceArn=arn)['Tags']}
+
+
+def _redshift_serverless_tags(client, arn):
+    return {t['key']: t['value'] for t in client.list_tags_for_resource(resourceArn=arn)['tags']}
+
+
+SERVICES = [
+    # sagemaker studio
+    {
+        'service': 'sagemaker',
+        'operation': 'list_apps',
+        'params': {},
+        'items': 'Apps',
+        'names': list(SAGEMAKER_APP_TYPES.values()),
+        'name_of': lambda app: SAGEMAKER_APP_TYPES.get(app['AppType']),
+        'active': lambda app: app['Status'] == 'InService',
+        'id': lambda app: sagemaker_app_id(app['DomainId'], app.get('UserProfileName', app.get('SpaceName')), app['AppName']),
+        'created': lambda app: app['CreationTime'],
+        'stop': _delete_sagemaker_app,
+        # list_appsではARNが取得できないので、タグによる停止回避は未対応
+        'tags': None,
+    },
+    # sagemaker endpoint
+    {
+        'service': 'sagemaker',
+        'operation': 'list_endpoints',
+        'params': {'StatusEquals': 'InService'},
+        'items': 'Endpoints',
+        'names': ['sagemaker_endpoints'],
+        'active': lambda ep: ep['EndpointStatus'] == 'InService',
+        'id': lambda ep: ep['EndpointName'],
+        'created': lambda ep: ep['CreationTime'],
+        'stop': lambda client, ep: client.delete_endpoint(EndpointName=ep['EndpointName']),
+        'tags': lambda client, ep: _sagemaker_tags(client, ep['EndpointArn']),
+    },
+    # sagemaker notebook instance
+    {
+        'service': 'sagemaker',
+        'operation': 'list_notebook_instances',
+        'params': {'StatusEquals': 'InService'},
+        'items': 'NotebookInstances',
+        'names': ['sagemaker_notebook_instances'],
+        'active': lambda nb: nb['NotebookInstanceStatus'] == 'InService',
+        'id': lambda nb: nb['NotebookInstanceName'],
+        # 停止・起動を繰り返すので、作成時刻ではなく最終更新（起動）時刻を使う
+        'created': lambda nb: nb['LastModifiedTime'],
+        'stop': lambda client, nb: client.stop_notebook_instance(NotebookInstanceName=nb['NotebookInstanceName']),
+        'tags': lambda client, nb: _sagemaker_tags(client, nb['NotebookInstanceArn']),
+    },
+    # redshift cluster
+    {
+        'service': 'redshift',
+        'operation': 'describe_clusters',
+        'params': {},
+        'items': 'Clusters',
+        'names': ['redshift_clusters'],
+        'active': lambda clu: not clu['ClusterStatus'] in ['deleting', 'paused'],
+        'id': lambda clu: clu['ClusterIdentifier'],
+        # describe_clustersには再開した時刻がないので作成時刻を使う
+        # （作成からの経過時間は稼働時間の上限なので、作成直後のクラスターだけ停止しない）
+        'created': lambda clu: clu['ClusterCreateTime'],
+        'stop': lambda client, clu: client.pause_cluster(ClusterIdentifier=clu['ClusterIdentifier']),
+        # describe_clustersのレスポンスにタグが含まれている
+        'tags': lambda client, clu: {t['Key']: t['Value'] for t in clu.get('Tags', [])},
+    },
+    # redshift serverless（停止のAPIがないので確認のみ）
+    {
+        'service': 'redshift-serverless',
+        'operation': 'list_workgroups',
+        'params': {},
+        'items': 'workgroups',
+        'names': ['redshift_serverless_workgroups'],
+        'active': lambda wg: wg['status'] != 'DELETING',
+        'id': lambda wg: wg['workgroupName'],
+        'created': lambda wg: wg['creationDate'],
+        'stop': None,
+        'tags': lambda client, wg: _redshift_serverless_tags(client, wg['workgroupArn']),
+    },
+    # comprehend endpoint
+    {
+        'service': 'comprehend',
+        'operation': 'list_endpoints',
+        'params': {},
+        'items': 'EndpointPropertiesList',
+        'names': ['comprehend_endpoints'],
+        'active': lambda ep: ep['Status'] == 'IN_SERVICE',
+        'id': lambda ep: ep['EndpointArn'],
+        'created': lambda ep: ep['CreationTime'],
+        'stop': lambda client, ep: client.delete_endpoint(EndpointArn=ep['EndpointArn']),
+        'tags': lambda client, ep: _comprehend_tags(client, ep['EndpointArn']),
+    },
+    # ec2（自動停止の対象外なので確認のみ）
+    {
+        'service': 'ec2',
+        'operation': 'describe_instances',
+        'params': {'Filters': [{'Name': 'instance-state-name', 'Values': ['running']}]},
+        'items': 'Reservations[].Instances[]',
+        'names': ['ec2 instances'],
+        'active': lambda i: i['State']['Name'] == 'running',
+        'id': lambda i: i['InstanceId'],
+        'created': lambda i: i['LaunchTime'],
+        'stop': None,
+        'tags': lambda client, i: {t['Key']: t['Value'] for t in i.get('Tags', [])},
+    },
+]
+
+
+def list_resources(client, spec):
+    """
+    指定サービスの稼働中のリソースを、全ページ分取得する
+
+    Parameters
+    ----------
+    client :  boto3.Session().client
+        適切な権限の付与された　service_name=spec['service']　のclient
+    spec : dict()
+        SERVICESの要素
+
+    returns
+    -------
+    res : [(string, dict())]
+        (service_name_text, リソース)のリスト
+    """
+    res = []
+    paginator = client.get_paginator(spec['operation'])
+    for item in paginator.paginate(**spec['params']).search(spec['items']):
+        if item is None or not spec['active'](item):
+            continue
+        name = spec['name_of'](item) if 'name_of' in spec else spec['names'][0]
+        if name is not None:
+            res.append((name, item))
+    return res
+
+
+def auto_stop_disabled(client, spec, item):
+    """
+    タグ（'AutoStop', 'False'）で自動停止が回避されているか
+
+    Parameters
+    ----------
+    client :  boto3.Session().client
+        適切な権限の付与された　service_name=spec['service']　のclient
+    spec : dict()
+        SERVICESの要素
+    item : dict()
+        list_resources()で取得したリソース
+
+    returns
+    -------
+    disabled : bool
+        自動停止しないならTrue
+    """
+    if spec['tags'] is None:
+        return False
+    try:
+        return spec['tags'](client, item).get('AutoStop') == 'False'
+    except botocore.exceptions.ClientError as e:
+        # タグが取得できなければ停止対象とする
+        return False
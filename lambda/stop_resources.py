@@ -7,216 +7,339 @@ AWS lambdaで日次バッチ的に利用することで、
 ■初期設定
 ・EventBridgeによる定期実行の設定
 ・タイムアウト時間の延長（10分あれば十分？）
+・（再開モードを使う場合）始業前に{"mode": "resume"}をeventに指定するEventBridgeの定期実行の設定
+　（例：平日8:30 JSTならcron(30 23 ? * SUN-THU *)、タイムアウトはRESUME_WAIT_SECONDSより長くする）
 
 ■更新時設定（初期にも必要）
-・AWS lambdaのコード更新
+・AWS lambdaのコード更新（service_registry.pyも同じ階層に配置する）
 ・role権限の更新
 
 ＜自動停止の対象サービス＞
-・SageMakerStudio（JupyterServer, KernelGateway）
+service_registry.pyのSERVICESに登録されたサービスのうち、stopが設定されているもの
+・SageMakerStudio（JupyterServer, KernelGateway, JupyterLab, CodeEditor）
 ・SageMakerEndpoint
+・SageMakerNotebookInstance
 ・RedshiftCluster
 ・ComprehendEndpoint
+（Tag,Key）＝（'AutoStop','False'）のリソースは停止しない（SageMakerStudioは未対応）
+STOP_MIN_AGE_HOURSの経過時間は、NotebookInstanceは最終更新（起動）時刻、それ以外は作成時刻から求める
+RedshiftClusterは再開した時刻が取得できないので、作成からSTOP_MIN_AGE_HOURS未満のものだけ停止せず、
+それ以外は再開してからの時間によらず停止する
+
+＜始業前の再開（eventに{"mode": "resume"}を指定したとき）＞
+一時停止中のRedshiftClusterのうち、下記のものを並列に再開（resume_cluster）し、
+availableになるまでリージョンごとにまとめてdescribe_clustersで状態を確認する
+・（Tag,Key）＝（'AutoResume','True'）のクラスター
+・RESUME_CLUSTERSに指定したクラスター
 
 ＜roleに設定すべきポリシー＞
 ・AWSLambdaBasicExecutionRole
 ・AmazonSageMakerFullAccess
 ・AmazonRedshiftFullAccess
 ・ComprehendFullAccess
+・（ACCOUNT_ROLE_ARNSを使う場合）該当roleへのsts:AssumeRole
+　（AssumeRole先のroleにも上記のポリシーと、このlambdaのroleを信頼するポリシーを設定する）
+
+＜環境変数（任意）＞
+・AWS_MAX_ATTEMPTS : API呼び出しの最大試行回数（デフォルト10）
+・MAX_WORKERS : アカウント×リージョンの並列実行数（デフォルト16）
+・ACCOUNT_ROLE_ARNS : 他アカウントもチェックする場合、AssumeRoleするrole ARN（カンマ区切り）
+・INCLUDE_SELF_ACCOUNT : lambda自身のアカウントもチェックするか（デフォルトtrue）
+・STOP_MIN_AGE_HOURS : 作成（起動）からこの時間以上経過したリソースだけ停止する（デフォルト0、RedshiftClusterは作成からの時間で判定）
+・DRY_RUN : trueなら停止せずに、各リソースの経過時間と停止するかどうかだけ表示する
+　（eventに{"dry_run": true}を指定しても同じ）
+・RESUME_CLUSTERS : 再開モードで再開するクラスターのClusterIdentifier（カンマ区切り）
+・RESUME_WAIT_SECONDS : 再開モードでavailableになるまで待つ最大秒数（デフォルト600）
+・RESUME_POLL_SECONDS : 再開モードで状態を確認する間隔の秒数（デフォルト30）
+・PROFILE : trueならlambda_handlerの処理時間とメモリ確保量を計測して表示する
+　（eventに{"profile": true}を指定しても同じ）
+・PROFILE_TOP_N : 計測結果を表示する件数（デフォルト20）
 
 
 ＜残課題＞
 ・ログの出力
-・タグによる自動停止の回避
-→　（Tag,Key）＝（'AutoAtop','False'）で止めないようにしようと考えているが未対応
+・SageMakerStudioのタグによる自動停止の回避
 """
 
+import os
+import time
 import json
-import boto3
+from datetime import datetime, timezone
 import botocore
+from service_registry import (
+    SERVICES, list_resources, auto_stop_disabled,
+    get_accounts, account_id, get_session, get_client, print_throttle_counts, profile_handler, get_executor,
+)
+
+# アカウント×リージョンを並列に確認するときのスレッド数
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', 16))
+# 作成（起動）からこの時間以上経過したリソースだけ停止する
+STOP_MIN_AGE_HOURS = float(os.environ.get('STOP_MIN_AGE_HOURS', 0))
+# 停止せずに判定結果だけ表示する
+DRY_RUN = os.environ.get('DRY_RUN', 'false').lower() == 'true'
+# 再開モードで再開するクラスター（タグ'AutoResume'='True'のものに加えて）
+RESUME_CLUSTERS = {i.strip() for i in os.environ.get('RESUME_CLUSTERS', '').split(',') if i.strip()}
+# 再開モードでavailableになるまで待つ最大秒数と、状態を確認する間隔
+RESUME_WAIT_SECONDS = float(os.environ.get('RESUME_WAIT_SECONDS', 600))
+RESUME_POLL_SECONDS = float(os.environ.get('RESUME_POLL_SECONDS', 30))
+
 
-def delete_sagemaker_studios(region):
+def judge_age(service_name_text, name, created, region, role_arn):
     """
-    sagemaker studioの['KernelGateway', 'JupyterServer']が
-    InServiceなら削除する
+    list系APIのレスポンスにある作成（起動）時刻から経過時間を求め、
+    STOP_MIN_AGE_HOURS以上経過していれば停止対象とする
 
     Parameters
     ----------
+    service_name_text : string
+        文字列を出力するときのサービス名
+    name : string
+        リソース名
+    created : datetime
+        作成（起動）時刻
     region : string
         AWSのリージョン情報
+    role_arn : string
+        AssumeRoleするrole ARN（lambda自身のアカウントはNone）
+
+    returns
+    -------
+    stop_resource : bool
+        停止対象かどうか
     """
-    client = boto3.Session().client(service_name="sagemaker", region_name=region)
-    try:
-        for app in client.list_apps()['Apps']:
-            if app['Status']=='InService' and app['AppType'] in ['KernelGateway', 'JupyterServer']:
-                stop_resource = True
-                desc = client.describe_app(
-                        DomainId = app['DomainId'],
-                        UserProfileName = app['UserProfileName'],
-                        AppType = app['AppType'],
-                        AppName = app['AppName']
-                    )
-                # tags = client.list_tags(
-                #     ResourceArn=desc['AppArn']
-                # )['Tags']
-                # for tag in tags:
-                #     if tag['Key'] == 'AutoStop' and tag['Value'] == 'False':
-                #         stop_resource = False
-                
-                if stop_resource:
-                    res = client.delete_app(
-                        DomainId = app['DomainId'],
-                        UserProfileName = app['UserProfileName'],
-                        AppType = app['AppType'],
-                        AppName = app['AppName']
-                    )
-                    print('stop {} in {}'.format(app['AppType'], region))
-                    print(res)
-    except botocore.exceptions.ClientError as e:
-        print('region-error in {} about {}'.format(region, 'sagemaker studio'))
-        print(e)
+    age_hours = (datetime.now(timezone.utc) - created).total_seconds() / 3600
+    stop_resource = age_hours >= STOP_MIN_AGE_HOURS
+    print('{} {} in {} ({}) : {:.1f} hours -> {}'.format(
+        service_name_text, name, region, account_id(role_arn), age_hours, 'stop' if stop_resource else 'keep'))
+    return stop_resource
+
 
-def delete_sagemaker_endpoints(region):
+def stop_service(spec, region, role_arn=None, dry_run=False):
     """
-    sagemaker studioのendpointが
-    InServiceなら削除する
+    指定サービスの稼働中のリソースのうち、STOP_MIN_AGE_HOURS以上経過していて
+    タグ（'AutoStop', 'False'）が付いていないものを停止する
 
     Parameters
     ----------
+    spec : dict()
+        service_registry.SERVICESの要素
     region : string
         AWSのリージョン情報
+    role_arn : string
+        AssumeRoleするrole ARN（lambda自身のアカウントはNone）
+    dry_run : bool
+        Trueなら停止せずに判定結果だけ表示する
     """
-    client = boto3.Session().client(service_name="sagemaker", region_name=region)
     try:
-        ep_list = client.list_endpoints(
-                    StatusEquals='InService'
-                )['Endpoints']
-        for ep in ep_list:
-            stop_resource = True
-            # tags = client.list_tags(
-            #     ResourceArn=ep['EndpointArn']
-            # )['Tags']
-            # for tag in tags:
-            #     if tag['Key'] == 'AutoStop' and tag['Value'] == 'False':
-            #         stop_resource = False
-            
-            if stop_resource:
-                res = client.delete_endpoint(
-                    EndpointName = ep['EndpointName']
-                )
-                print('stop {} in {}'.format('sagemaker endpoint', region))
-                print(res)
+        client = get_client(spec['service'], region, role_arn)
+        for name, item in list_resources(client, spec):
+            stop_resource = judge_age(name, spec['id'](item), spec['created'](item), region, role_arn)
+            # タグの確認は停止対象になったものだけ行う
+            if stop_resource and auto_stop_disabled(client, spec, item):
+                print('skip {} {} in {} ({}) : AutoStop=False'.format(name, spec['id'](item), region, account_id(role_arn)))
+                stop_resource = False
+
+            if stop_resource and not dry_run:
+                response = spec['stop'](client, item)
+                print('stop {} in {} ({})'.format(name, region, account_id(role_arn)))
+                print(response)
     except botocore.exceptions.ClientError as e:
-        print('region-error in {} about {}'.format(region, 'sagemaker endpoint'))
+        print('region-error in {} ({}) about {}'.format(region, account_id(role_arn), ', '.join(spec['names'])))
         print(e)
 
-def delete_comprehend_endpoints(region):
+def stop_resources(dry_run=False):
+    """
+    service_registry.SERVICESのうち停止できるサービスについて、
+    サービス停止関数を全アカウント・全リージョンについて並列に実行する
+
+    Parameters
+    ----------
+    dry_run : bool
+        Trueなら停止せずに判定結果だけ表示する
+    """
+    tasks = []
+    for role_arn in get_accounts():
+        for spec in SERVICES:
+            if spec['stop'] is None:
+                continue
+            for region in get_session().get_available_regions(spec['service']):
+                tasks.append((spec, region, role_arn))
+
+    with get_executor(MAX_WORKERS) as executor:
+        futures = [executor.submit(stop_service, spec, region, role_arn, dry_run) for spec, region, role_arn in tasks]
+    # ClientError以外の例外はここで送出させる
+    for future in futures:
+        future.result()
+    print_throttle_counts()
+
+
+def describe_redshift_clusters(region, role_arn=None):
     """
-    comprehendのendpointが
-    IN_SERVICEなら削除する
+    リージョン内の全クラスターを、全ページ分まとめて取得する
+    （クラスターごとにdescribe_clustersを呼ばないようにする）
 
     Parameters
     ----------
     region : string
         AWSのリージョン情報
+    role_arn : string
+        AssumeRoleするrole ARN（lambda自身のアカウントはNone）
+
+    returns
+    -------
+    clusters : [dict()]
+        describe_clustersのClusters
     """
-    client = boto3.Session().client(service_name="comprehend", region_name=region)
+    client = get_client('redshift', region, role_arn)
+    paginator = client.get_paginator('describe_clusters')
+    return list(paginator.paginate().search('Clusters'))
+
+
+def select_resume_clusters(region, role_arn=None):
+    """
+    一時停止中のクラスターのうち、タグ（'AutoResume', 'True'）が付いているか
+    RESUME_CLUSTERSに指定されているものを選ぶ
+
+    Parameters
+    ----------
+    region : string
+        AWSのリージョン情報
+    role_arn : string
+        AssumeRoleするrole ARN（lambda自身のアカウントはNone）
+
+    returns
+    -------
+    res : [string]
+        再開するクラスターのClusterIdentifier
+    """
+    res = []
     try:
-        for ep in client.list_endpoints()['EndpointPropertiesList']:
-            if ep['Status'] == 'IN_SERVICE':
-                stop_resource = True
-                # tagの取得がうまく働いているか不明なので、現状は全てのエンドポイントを停止していると思ったほうが良い
-                try:
-                    tags = client.list_tags_for_resource(
-                        ResourceArn=ep['EndpointArn']
-                    )['Tags']
-
-                    if tags['AutoStop'] == 'False':
-                        stop_resource = False
-                except:
-                    pass
-
-                if stop_resource:
-                    response = client.delete_endpoint(
-                        EndpointArn= ep['EndpointArn']
-                    )
-                    print('stop {} in {}'.format('comprehend endpoint', region))
-                    print(response)
+        for clu in describe_redshift_clusters(region, role_arn):
+            if clu['ClusterStatus'] != 'paused':
+                continue
+            tags = {t['Key']: t['Value'] for t in clu.get('Tags', [])}
+            if tags.get('AutoResume') == 'True' or clu['ClusterIdentifier'] in RESUME_CLUSTERS:
+                res.append(clu['ClusterIdentifier'])
     except botocore.exceptions.ClientError as e:
-        print('region-error in {} about {}'.format(region, 'comprehend endpoint'))
+        print('region-error in {} ({}) about redshift_clusters'.format(region, account_id(role_arn)))
         print(e)
+    return res
+
 
-def pause_redshift_clusters(region):
+def resume_redshift_cluster(identifier, region, role_arn=None):
     """
-    redshiftのclusterが
-    ['deleting', 'paused']以外なら停止（'paused'）する
+    クラスターを再開する
 
     Parameters
     ----------
+    identifier : string
+        ClusterIdentifier
     region : string
         AWSのリージョン情報
+    role_arn : string
+        AssumeRoleするrole ARN（lambda自身のアカウントはNone）
+
+    returns
+    -------
+    resumed : bool
+        再開を開始できたかどうか
     """
-    client = boto3.Session().client(service_name="redshift", region_name=region)
     try:
-        for clu in client.describe_clusters()['Clusters']:
-            if not clu['ClusterStatus'] in ['deleting', 'paused']:
-                stop_resource = True
-                # tagの取得がうまくいかないので、現状は全てのクラスターを停止
-#                 try:
-#                     tags = client.describe_tags(
-#                         ResourceName=clu['ClusterNamespaceArn'],
-#                         ResourceType='Cluster',
-#                     )['TaggedResources'][0]['Tag']
-                    
-#                     for tag in tags:
-#                         if tag['Key'] == 'AutoStop' and tag['Value'] == 'False':
-#                                 stop_resource = False
-                        
-#                     if tags['AutoStop'] == 'False':
-#                         stop_resource = False
-#                 except:
-#                     pass
-                
-                if stop_resource:
-                    response = client.pause_cluster(
-                        ClusterIdentifier= clu['ClusterIdentifier']
-                    )
-                    print('stop {} in {}'.format('redshift cluster', region))
-                    print(response)
+        client = get_client('redshift', region, role_arn)
+        client.resume_cluster(ClusterIdentifier=identifier)
+        print('resume redshift_clusters {} in {} ({})'.format(identifier, region, account_id(role_arn)))
+        return True
     except botocore.exceptions.ClientError as e:
-        print('region-error in {} about {}'.format(region, 'redshift cluster'))
+        print('resume-error redshift_clusters {} in {} ({})'.format(identifier, region, account_id(role_arn)))
         print(e)
+        return False
+
+
+def wait_clusters_available(pending):
+    """
+    再開したクラスターがavailableになるまで、RESUME_POLL_SECONDSごとに
+    (account, region)単位で1回のdescribe_clustersにまとめて並列に状態を確認する
+    （RESUME_WAIT_SECONDSを過ぎたら待つのをやめる）
+
+    Parameters
+    ----------
+    pending : dict()
+        (region, role_arn) -> availableを待つClusterIdentifierのset
+    """
+    started = time.monotonic()
+    while pending:
+        time.sleep(RESUME_POLL_SECONDS)
+        with get_executor(MAX_WORKERS) as executor:
+            futures = [(key, executor.submit(describe_redshift_clusters, *key)) for key in pending]
+
+        elapsed = time.monotonic() - started
+        for (region, role_arn), future in futures:
+            try:
+                status = {clu['ClusterIdentifier']: clu['ClusterStatus'] for clu in future.result()}
+            except botocore.exceptions.ClientError as e:
+                # 一時的なエラーなら次の確認で取り直す
+                print(e)
+                continue
+            for identifier in sorted(pending[(region, role_arn)]):
+                # 消えたクラスターは待たない
+                if status.get(identifier, 'available') == 'available':
+                    pending[(region, role_arn)].discard(identifier)
+                print('redshift_clusters {} in {} ({}) : {} ({:.0f}s)'.format(
+                    identifier, region, account_id(role_arn), status.get(identifier, 'not found'), elapsed))
+        pending = {key: ids for key, ids in pending.items() if ids}
+
+        if pending and elapsed >= RESUME_WAIT_SECONDS:
+            for (region, role_arn), ids in pending.items():
+                print('timeout redshift_clusters {} in {} ({})'.format(', '.join(sorted(ids)), region, account_id(role_arn)))
+            break
+
+
+def resume_resources(dry_run=False):
+    """
+    始業前に一時停止中のRedshiftClusterを全アカウント・全リージョンについて並列に再開し、
+    availableになるまで待つ
+
+    Parameters
+    ----------
+    dry_run : bool
+        Trueなら再開せずに対象のクラスターだけ表示する
+    """
+    tasks = [(region, role_arn)
+             for role_arn in get_accounts()
+             for region in get_session().get_available_regions('redshift')]
+
+    with get_executor(MAX_WORKERS) as executor:
+        futures = [(key, executor.submit(select_resume_clusters, *key)) for key in tasks]
+        targets = [(identifier, region, role_arn) for (region, role_arn), future in futures for identifier in future.result()]
+
+        if dry_run:
+            for identifier, region, role_arn in targets:
+                print('resume redshift_clusters {} in {} ({}) : dry run'.format(identifier, region, account_id(role_arn)))
+            return
+
+        futures = [(target, executor.submit(resume_redshift_cluster, *target)) for target in targets]
+        pending = dict()
+        for (identifier, region, role_arn), future in futures:
+            if future.result():
+                pending.setdefault((region, role_arn), set()).add(identifier)
+
+    wait_clusters_available(pending)
+    print_throttle_counts()
 
-def stop_resources():
-    """
-    サービス停止関数を全リージョンについて実行する
-    """
-    # sagemaker
-    regions = boto3.Session().get_available_regions('sagemaker')
-    # regions = ['eu-west-2']
-    for region in regions:
-        delete_sagemaker_endpoints(region)
-        delete_sagemaker_studios(region)
-        
-    # redshift
-    regions = boto3.Session().get_available_regions('redshift')
-    # regions = ['eu-west-2']
-    for region in regions:
-        pause_redshift_clusters(region)
-    
-    # comprehend
-    regions = boto3.Session().get_available_regions('comprehend')
-    # regions = ['eu-west-2']
-    for region in regions:
-        delete_comprehend_endpoints(region)
 
+@profile_handler
 def lambda_handler(event, context):
     """
     lambdaが参照する関数
     （lambda_handler(event, context)の形で設定する必要がある）
-    stop_resources()を実行するだけ
+    eventに{"mode": "resume"}が指定されていればresume_resources()を、
+    それ以外はstop_resources()を実行する
     """
-    stop_resources()
+    dry_run = DRY_RUN or bool(event.get('dry_run'))
+    if event.get('mode') == 'resume':
+        resume_resources(dry_run=dry_run)
+    else:
+        stop_resources(dry_run=dry_run)
     print('all done')
     return {
         'statusCode': 200,